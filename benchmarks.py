@@ -0,0 +1,143 @@
+''' Micro-benchmarks for mad_responder. These don't need a database or any
+    upstream servers. Run all of them with
+        python3 benchmarks.py
+    or name the ones to run, e.g.
+        python3 benchmarks.py serializer
+'''
+from datetime import datetime, timedelta
+from decimal import Decimal
+import json
+import os
+import subprocess
+import sys
+from timeit import repeat
+import mad_responder
+
+
+def legacy_encoder():
+    ''' The JSONEncoder that generate_response used before the pluggable
+        serializer (Flask's jsonify plus CustomJSONEncoder)
+    '''
+    class LegacyJSONEncoder(json.JSONEncoder):
+        def default(self, o): # pylint: disable=E0202
+            try:
+                if isinstance(o, datetime):
+                    return o.strftime('%a, %-d %b %Y %H:%M:%S')
+                iterable = iter(o)
+            except TypeError:
+                pass
+            else:
+                return list(iterable)
+            if isinstance(o, Decimal):
+                return str(o)
+            return json.JSONEncoder.default(self, o)
+    return LegacyJSONEncoder
+
+
+def best_of(func, number=1):
+    return min(repeat(func, number=number, repeat=3)) / number
+
+
+def bench_serializer(rows=100000):
+    ''' Serialize an annotation_property_vw-sized result with the legacy
+        encoder and with each available serializer backend
+    '''
+    start = datetime(2019, 1, 1)
+    result = {'rest': {'row_count': rows, 'error': False},
+              'data': [{'id': i, 'annotation_id': i // 10, 'annotation': 'annot_%d' % (i // 10),
+                        'type': 'blocks_annotated', 'cv': 'annotation_property',
+                        'value': Decimal('%d.25' % i),
+                        'create_date': start + timedelta(seconds=i)}
+                       for i in range(rows)]}
+    encoder = legacy_encoder()
+    legacy = best_of(lambda: json.dumps(result, cls=encoder, sort_keys=True,
+                                        separators=(',', ':')))
+    print("serializer: %d rows" % (rows,))
+    print("  %-8s %8.3f sec" % ('legacy', legacy))
+    backends = ['json'] + (['orjson'] if mad_responder.orjson else [])
+    for backend in backends:
+        mad_responder.app.config['JSON_SERIALIZER'] = backend
+        elapsed = best_of(lambda: mad_responder.dumps(result))
+        print("  %-8s %8.3f sec (%.1fx)" % (backend, elapsed, legacy / elapsed))
+
+
+def bench_columnar(rows=100000):
+    ''' Build and serialize the same rows as objects (the default format) and
+        as arrays (_format=columnar)
+    '''
+    start = datetime(2019, 1, 1)
+    columns = ['id', 'annotation_id', 'annotation', 'type', 'cv', 'value', 'create_date']
+    tuples = [(i, i // 10, 'annot_%d' % (i // 10), 'blocks_annotated', 'annotation_property',
+               Decimal('%d.25' % i), start + timedelta(seconds=i)) for i in range(rows)]
+    builders = (('json', lambda: {'data': [dict(zip(columns, row)) for row in tuples]}),
+                ('columnar', lambda: {'columns': columns, 'rows': tuples}))
+    print("columnar: %d rows" % (rows,))
+    for fmt, build in builders:
+        size = len(mad_responder.dumps(build()))
+        elapsed = best_of(lambda build=build: mad_responder.dumps(build()))
+        print("  %-8s %8.3f sec %10d bytes" % (fmt, elapsed, size))
+
+
+def legacy_neuron_records(rows):
+    ''' The /unassigned response builder before it was made linear: it
+        re-sorted the whole list after adding each row
+    '''
+    nlist = []
+    data = []
+    for row in rows:
+        ndat = row[0]
+        nlist.append({"body_id": ndat['bodyId'], "size": ndat['size'],
+                      "status": ndat.get('status', ''),
+                      "timestamp": ndat.get('timestamp', '')})
+        data = sorted(nlist, key=lambda i: i['timestamp'])
+    return data
+
+
+def neuprint_rows(rows):
+    ''' Synthetic neuPrint custom query rows, ordered by size '''
+    return [[{'bodyId': 1000000000 + i, 'size': (rows - i) * 1000, 'status': '0.5assign',
+              'timestamp': '2019-%02d-%02d' % (i % 12 + 1, i % 28 + 1)}]
+            for i in range(rows)]
+
+
+def bench_unassigned():
+    ''' Build /unassigned responses from synthetic neuPrint rows. The legacy
+        builder is quadratic, so it's only run on the smaller sizes.
+    '''
+    print("unassigned:")
+    for rows in (1000, 4000, 10000, 100000):
+        data = neuprint_rows(rows)
+        if rows <= 4000:
+            legacy = best_of(lambda: legacy_neuron_records(data))
+            print("  %-8s %7d rows %8.3f sec" % ('legacy', rows, legacy))
+        elapsed = best_of(lambda: mad_responder.neuron_records(data))
+        print("  %-8s %7d rows %8.3f sec" % ('current', rows, elapsed))
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+# Clients that importing mad_responder shouldn't load
+HEAVY_MODULES = ('elasticsearch', 'flask_swagger', 'kafka', 'requests')
+IMPORT_CHECK = "import sys, mad_responder; print(','.join(mod for mod in %r if mod in sys.modules))"
+
+
+def bench_import():
+    ''' Time a cold import of mad_responder in a fresh interpreter, and list
+        any heavy clients it loaded eagerly
+    '''
+    command = [sys.executable, '-c', IMPORT_CHECK % (HEAVY_MODULES,)]
+    loaded = subprocess.run(command, check=True, stdout=subprocess.PIPE, cwd=HERE,
+                            universal_newlines=True).stdout.strip()
+    elapsed = best_of(lambda: subprocess.run(command, check=True, stdout=subprocess.DEVNULL,
+                                             cwd=HERE))
+    print("import: %.3f sec" % (elapsed,))
+    print("  eagerly loaded: %s" % (loaded or 'none',))
+
+
+BENCHMARKS = {'serializer': bench_serializer,
+              'columnar': bench_columnar,
+              'unassigned': bench_unassigned,
+              'import': bench_import}
+
+if __name__ == '__main__':
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
@@ -0,0 +1,9 @@
+''' gunicorn settings for mad_responder '''
+
+
+def post_worker_init(worker): # pylint: disable=W0613
+    ''' Initialize the worker's dependencies (in parallel, with a timeout)
+        before it starts taking requests
+    '''
+    from mad_responder import warmup
+    print("Worker dependencies: %s" % (warmup(),))
@@ -1,62 +1,94 @@
-from datetime import datetime, timedelta
+import atexit
+from collections import deque, OrderedDict
+import csv
+from datetime import date, datetime, time as dtime, timedelta
+from decimal import Decimal
+import gzip
+import hashlib
+from importlib.util import find_spec
+from inspect import isgenerator
+from operator import itemgetter
+import io
 import json
 import os
 import platform
 import re
 import sys
-from time import time
-from urllib.parse import parse_qs
-import elasticsearch
-from flask import Flask, g, render_template, request, jsonify
-from flask.json import JSONEncoder
+import threading
+from time import sleep, time
+from urllib.parse import parse_qs, parse_qsl
+from uuid import UUID
+import zlib
+from flask import (Blueprint, Flask, g, has_request_context, render_template,
+                   request, Response, stream_with_context)
+from flask.ctx import _AppCtxGlobals
 from flask_cors import CORS
-from flask_swagger import swagger
-from jwt import decode
-from kafka import KafkaProducer
-from kafka.errors import KafkaError
+from jwt import decode, InvalidTokenError
 import pymysql.cursors
-import requests
+from werkzeug.http import http_date
+try:
+    import orjson
+except ImportError: # pragma: no cover
+    orjson = None
+try:
+    import brotli
+except ImportError: # pragma: no cover
+    brotli = None
 
 
 # SQL statements
 SQL = {
-    'CVREL': "SELECT subject,relationship,object FROM cv_relationship_vw "
-             + "WHERE subject_id=%s OR object_id=%s",
-    'CVTERMREL': "SELECT subject,relationship,object FROM "
-                 + "cv_term_relationship_vw WHERE subject_id=%s OR "
-                 + "object_id=%s",
+    'CVREL': "SELECT subject_id,subject,relationship,object_id,object FROM "
+             + "cv_relationship_vw WHERE subject_id IN (%s) OR "
+             + "object_id IN (%s)",
+    'CVTERMREL': "SELECT subject_id,subject,relationship,object_id,object FROM "
+                 + "cv_term_relationship_vw WHERE subject_id IN (%s) OR "
+                 + "object_id IN (%s)",
+    'CVRELALL': "SELECT subject_id,subject,relationship,object_id,object FROM "
+                + "cv_relationship_vw",
+    'CVTERMRELALL': "SELECT subject_id,subject,relationship,object_id,object "
+                    + "FROM cv_term_relationship_vw",
 }
 
-class CustomJSONEncoder(JSONEncoder):
-    def default(self, obj):   # pylint: disable=E0202, W0221
+# Query string keys that control a query rather than filter it
+CONTROL_KEYS = ['_limit', '_offset', '_after', '_stream', '_timing', '_format']
+NDJSON = 'application/x-ndjson'
+# Assignment columns set by each /assignment_transitions operation
+ASSIGNMENT_TRANSITIONS = {'start': 'start_date=NOW()',
+                          'complete': 'complete_date=NOW()',
+                          'reset': 'start_date=0,complete_date=0,is_complete=0'}
+# Values for the _format key: rows as objects, as arrays (with a separate
+# list of columns), or one array of values per column; or exported as
+# CSV/TSV (streamed), an Arrow IPC stream or Parquet
+FORMATS = ('json', 'columnar', 'columns', 'csv', 'tsv', 'arrow', 'parquet')
+EXPORT_MIMETYPES = {'csv': 'text/csv',
+                    'tsv': 'text/tab-separated-values',
+                    'arrow': 'application/vnd.apache.arrow.stream',
+                    'parquet': 'application/vnd.apache.parquet'}
+# Categories reported by ?_timing=1
+TIMINGS = ('auth', 'sql_generation', 'execute', 'fetch', 'enrichment', 'upstream',
+           'publish', 'serialization')
+WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+MONTHS = ('Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct',
+          'Nov', 'Dec')
+
+class CountingCursor(pymysql.cursors.DictCursor):
+    ''' DictCursor that keeps track of how many statements it has executed '''
+    statements = 0
+
+    def execute(self, query, args=None):
+        self.statements += 1
+        started = time()
         try:
-            if isinstance(obj, datetime):
-                return obj.strftime('%a, %-d %b %Y %H:%M:%S')
-            iterable = iter(obj)
-        except TypeError:
-            pass
-        else:
-            return list(iterable)
-        return JSONEncoder.default(self, obj)
+            return super().execute(query, args)
+        finally:
+            add_timing('execute', started)
 
 __version__ = '0.2.0'
-app = Flask(__name__)
-app.json_encoder = CustomJSONEncoder
-app.config.from_pyfile("config.cfg")
-CONFIG = {'config': {'url': app.config['CONFIG_ROOT']}}
-CVTERMS = dict()
-SERVER = dict()
-CORS(app)
-conn = pymysql.connect(host=app.config['MYSQL_DATABASE_HOST'],
-                       user=app.config['MYSQL_DATABASE_USER'],
-                       password=app.config['MYSQL_DATABASE_PASSWORD'],
-                       db=app.config['MYSQL_DATABASE_DB'],
-                       cursorclass=pymysql.cursors.DictCursor)
-cursor = conn.cursor()
-app.config['STARTTIME'] = time()
-app.config['STARTDT'] = datetime.now()
-IDCOLUMN = 0
-START_TIME = ESEARCH = PRODUCER = ''
+# Endpoints are registered on this blueprint; create_app sets app
+BLUEPRINT = Blueprint('mad_responder', __name__)
+app = SPEC = None
+SPEC_LOCK = threading.Lock()
 
 
 # *****************************************************************************
@@ -79,45 +111,1079 @@ class InvalidUsage(Exception):
         retval['rest'] = {'error': self.message}
         return retval
 
+
+class RequestGlobals(_AppCtxGlobals):
+    ''' Flask's g, with a pooled database connection (g.db) and cursor (g.c)
+        checked out when a request first uses them, so views that don't
+        touch the database work without it
+    '''
+    def __getattr__(self, name):
+        if name in ('db', 'c') and has_request_context():
+            self.db = POOL.get()
+            self.c = self.db.cursor()
+            return self.__dict__[name]
+        return super().__getattr__(name)
+
+
+class ConnectionPool():
+    ''' Bounded, thread-safe pool of MySQL connections. Connections are opened
+        on demand (up to maxsize), kept warm down to minsize, evicted after
+        sitting idle for idle_seconds, and pinged on checkout if they haven't
+        been used for check_seconds.
+    '''
+    def __init__(self, minsize, maxsize, timeout, idle_seconds, check_seconds,
+                 **kwargs):
+        self.minsize = minsize
+        self.maxsize = max(maxsize, 1)
+        self.timeout = timeout
+        self.idle_seconds = idle_seconds
+        self.check_seconds = check_seconds
+        self.connect_args = kwargs
+        self.cond = threading.Condition()
+        self.idle = deque()
+        self.size = 0
+        self.stats = {'checkouts': 0, 'connects': 0, 'evictions': 0,
+                      'failed_checks': 0, 'timeouts': 0}
+
+    def _connect(self):
+        self.stats['connects'] += 1
+        return pymysql.connect(**self.connect_args)
+
+    def _evict(self):
+        ''' Close idle connections beyond minsize that have expired. Caller
+            must hold the lock.
+        '''
+        now = time()
+        while len(self.idle) > self.minsize \
+              and now - self.idle[0][1] >= self.idle_seconds:
+            dbc = self.idle.popleft()[0]
+            self.size -= 1
+            self.stats['evictions'] += 1
+            try:
+                dbc.close()
+            except Exception: # pragma: no cover
+                pass
+
+    def get(self, timeout=None):
+        ''' Check out a connection, waiting up to timeout (default: the
+            pool's timeout) seconds for one to be returned if the pool is
+            exhausted.
+        '''
+        deadline = time() + (self.timeout if timeout is None else timeout)
+        with self.cond:
+            while True:
+                self._evict()
+                if self.idle:
+                    dbc, last_used = self.idle.pop()
+                    break
+                if self.size < self.maxsize:
+                    self.size += 1
+                    dbc = last_used = None
+                    break
+                remaining = deadline - time()
+                if remaining <= 0:
+                    self.stats['timeouts'] += 1
+                    raise InvalidUsage('Timed out waiting for a database connection', 503)
+                self.cond.wait(remaining)
+            self.stats['checkouts'] += 1
+        try:
+            if dbc is None:
+                dbc = self._connect()
+            elif time() - last_used >= self.check_seconds:
+                try:
+                    dbc.ping(reconnect=True)
+                except Exception:
+                    self.stats['failed_checks'] += 1
+                    dbc = self._connect()
+        except Exception as err:
+            self.release()
+            raise InvalidUsage(sql_error(err), 500)
+        return dbc
+
+    def put(self, dbc):
+        ''' Return a connection to the pool. Any open transaction is rolled
+            back; connections that can't be rolled back are discarded.
+        '''
+        try:
+            if not dbc.open:
+                raise pymysql.err.InterfaceError('Connection is closed')
+            dbc.rollback()
+        except Exception:
+            try:
+                dbc.close()
+            except Exception: # pragma: no cover
+                pass
+            self.release()
+            return
+        with self.cond:
+            self.idle.append((dbc, time()))
+            self.cond.notify()
+
+    def release(self):
+        ''' Give up a slot held by a connection that was discarded '''
+        with self.cond:
+            self.size -= 1
+            self.cond.notify()
+
+    def status(self):
+        with self.cond:
+            retval = {'size': self.size, 'idle': len(self.idle),
+                      'in_use': self.size - len(self.idle),
+                      'min': self.minsize, 'max': self.maxsize}
+        retval.update(self.stats)
+        return retval
+
+
+class CVCache():
+    ''' In-memory copy of the cv and cv_term_vw tables, the CV/CV term
+        lookups derived from them, and their relationship graphs. The copy is
+        refreshed in the background every ttl seconds, and can be refreshed on
+        demand after CVs or CV terms are added.
+    '''
+    TABLES = {'cv': 'CVRELALL', 'cv_term_vw': 'CVTERMRELALL'}
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.data = None
+        self.loaded = 0
+        self.refresher = None
+        self.wake = threading.Event()
+
+    def refresh(self, cursor):
+        data = {'terms': dict(), 'term_ids': dict()}
+        for table, stmt in CVCache.TABLES.items():
+            cursor.execute('SELECT * FROM ' + table)
+            rows = list(cursor.fetchall())
+            cursor.execute(SQL[stmt])
+            data[table] = {'rows': rows,
+                           'columns': set(rows[0].keys()) if rows else set(),
+                           'relationships': group_relationships(cursor.fetchall())}
+        for row in data['cv_term_vw']['rows']:
+            data['terms'].setdefault(row['cv'], dict())[row['cv_term']] = row['id']
+            data['term_ids'][row['id']] = (row['cv'], row['cv_term'])
+        with self.lock:
+            self.data = data
+            self.loaded = time()
+
+    def start(self):
+        ''' Start the background refresh thread (once per process) '''
+        with self.lock:
+            if self.refresher and self.refresher.is_alive():
+                return
+            self.refresher = threading.Thread(target=self._refresh_loop,
+                                              name='cv-cache', daemon=True)
+            self.refresher.start()
+
+    def refresh_soon(self):
+        ''' Have the background thread reload the copy now '''
+        self.wake.set()
+
+    def invalidate(self):
+        ''' Drop the copy (CV endpoints fall back to SQL) and have the
+            background thread reload it now
+        '''
+        with self.lock:
+            self.data = None
+            self.loaded = 0
+        self.wake.set()
+
+    def _refresh_loop(self):
+        while True:
+            self.wake.wait(self.ttl)
+            self.wake.clear()
+            dbc = None
+            try:
+                dbc = POOL.get()
+                cursor = dbc.cursor()
+                self.refresh(cursor)
+                cursor.close()
+            except Exception as err:
+                print("Could not refresh CV cache: %s" % (getattr(err, 'message', err),))
+            finally:
+                if dbc:
+                    POOL.put(dbc)
+
+    def term_id(self, cv, term):
+        data = self.data
+        if not data:
+            return None
+        return data['terms'].get(cv, dict()).get(term)
+
+    def term(self, term_id):
+        data = self.data
+        return data['term_ids'].get(term_id) if data else None
+
+    def relationships(self, table):
+        data = self.data
+        return data[table]['relationships'] if data else dict()
+
+    def select(self, result, table, query_string, columns='*'):
+        ''' Apply generate_sql-style filtering, column selection, sorting and
+            paging to a cached table. Returns (rows, idcolumn), or None if the
+            cache isn't loaded or the query needs something only SQL can do.
+        '''
+        data = self.data
+        if not data:
+            return None
+        table_columns = data[table]['columns']
+        ipd = parse_qs(query_string) if query_string else dict()
+        selected = None if columns == '*' else columns.split(',')
+        filters = []
+        order = []
+        distinct = False
+        for key, val in ipd.items():
+            if key == '_columns':
+                if columns == '*':
+                    selected = val[0].split(',')
+            elif key == '_sort':
+                for term in val[0].split(','):
+                    match = re.match(r'^\s*(\w+)(?:\s+(asc|desc))?\s*$', term, re.I)
+                    if not match:
+                        return None
+                    order.append((match.group(1),
+                                  (match.group(2) or '').lower() == 'desc'))
+            elif key == '_distinct':
+                distinct = True
+            elif key in CONTROL_KEYS:
+                continue
+            else:
+                match = re.match(r'^(\w+)([!><]?)$', key)
+                if not match:
+                    return None
+                filters.append((match.group(1), match.group(2), val[0]))
+        for col in [fil[0] for fil in filters] + [srt[0] for srt in order] \
+                   + (selected or []):
+            if col not in table_columns:
+                return None
+        try:
+            rows = [row for row in data[table]['rows']
+                    if all(cached_match(row[col], oper, val) for col, oper, val in filters)]
+        except ValueError:
+            return None
+        for col, descending in reversed(order):
+            rows.sort(key=lambda row, col=col: cached_sort_key(row[col]),
+                      reverse=descending)
+        limit, offset, after = page_parameters(result, ipd)
+        if after is not None:
+            try:
+                after = int(after)
+            except ValueError:
+                return None
+            rows = sorted([row for row in rows if row['id'] is not None and row['id'] > after],
+                          key=lambda row: row['id'])
+        if selected:
+            rows = [{col: row[col] for col in selected} for row in rows]
+            if distinct:
+                rows = list({tuple(row.items()): row for row in rows}.values())
+        # Page after _distinct, as SQL does
+        rows = rows[offset:offset+limit]
+        if not selected:
+            rows = [dict(row) for row in rows]
+        return rows, int(bool(selected and 'id' in selected))
+
+
+class ProfileCache():
+    ''' Bounded LRU cache of neuPrint profiles keyed by bearer token. Each
+        entry expires at its own time (normally the token's exp claim).
+    '''
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.stats = {'hits': 0, 'misses': 0, 'expired': 0, 'evictions': 0,
+                      'verified_locally': 0}
+
+    def get(self, token):
+        with self.lock:
+            entry = self.entries.get(token)
+            if entry:
+                if entry[1] > time():
+                    self.entries.move_to_end(token)
+                    self.stats['hits'] += 1
+                    return entry[0]
+                del self.entries[token]
+                self.stats['expired'] += 1
+            self.stats['misses'] += 1
+        return None
+
+    def put(self, token, profile, expires):
+        if expires <= time() or self.maxsize <= 0:
+            return
+        with self.lock:
+            self.entries[token] = (profile, expires)
+            self.entries.move_to_end(token)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def status(self):
+        with self.lock:
+            retval = {'size': len(self.entries), 'max': self.maxsize}
+            retval.update(self.stats)
+        return retval
+
+
+class CircuitBreaker():
+    ''' Fail fast after threshold consecutive failures. Once reset_seconds
+        have passed, a single test request is let through (half-open); its
+        success closes the breaker and its failure reopens it. A test request
+        that never reports back is replaced after another reset_seconds.
+    '''
+    def __init__(self, threshold, reset_seconds):
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.opened = 0
+        self.probe = 0
+        self.trips = 0
+
+    def allow(self):
+        with self.lock:
+            if self.failures < self.threshold:
+                return True
+            now = time()
+            if now - self.opened < self.reset_seconds or now - self.probe < self.reset_seconds:
+                return False
+            self.probe = now
+            return True
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.probe = 0
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.probe = 0
+            if self.failures >= self.threshold:
+                if time() - self.opened >= self.reset_seconds:
+                    self.trips += 1
+                self.opened = time()
+
+    def status(self):
+        with self.lock:
+            return {'open': self.failures >= self.threshold
+                            and time() - self.opened < self.reset_seconds,
+                    'half_open': bool(self.probe),
+                    'consecutive_failures': self.failures,
+                    'trips': self.trips}
+
+
+class KafkaJournal():
+    ''' Bounded on-disk spill queue for Kafka messages that couldn't be
+        delivered. Messages are appended one per line, and are claimed and
+        resent as a batch once the broker is reachable again. The journal is
+        shared by every worker, so its size is taken from the file.
+    '''
+    def __init__(self, path, maxsize):
+        self.path = path
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.size = 0
+        self.counted = None
+        self.replaying = False
+        self.replayer = None
+
+    def _count(self):
+        ''' Return the number of journaled messages, re-reading the file only
+            if it changed (here or in another worker) since it was counted
+        '''
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            self.size, self.counted = 0, None
+            return 0
+        if (stat.st_ino, stat.st_size, stat.st_mtime_ns) != self.counted:
+            with open(self.path, 'rb') as jfile:
+                self.size = sum(1 for _ in jfile)
+            self.counted = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        return self.size
+
+    def pending(self):
+        with self.lock:
+            try:
+                return self._count()
+            except OSError:
+                return 0
+
+    def append(self, value):
+        with self.lock:
+            try:
+                if self._count() >= self.maxsize:
+                    return False
+                with open(self.path, 'ab') as jfile:
+                    jfile.write(value + b'\n')
+                stat = os.stat(self.path)
+            except OSError as err:
+                print("Could not write to Kafka journal %s: %s" % (self.path, err))
+                return False
+            self.size += 1
+            self.counted = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+            return True
+
+    def start_replay(self):
+        with self.lock:
+            if self.replaying:
+                return False
+            self.replaying = True
+            return True
+
+    def take(self):
+        ''' Claim every journaled message. The journal is renamed first so
+            other threads and workers keep appending to a fresh file.
+        '''
+        claimed = '%s.%d' % (self.path, os.getpid())
+        with self.lock:
+            self.size, self.counted = 0, None
+            try:
+                os.replace(self.path, claimed)
+            except OSError:
+                return []
+        with open(claimed, 'rb') as jfile:
+            values = [line.rstrip(b'\n') for line in jfile if line.strip()]
+        os.remove(claimed)
+        return values
+
+    def start(self, interval, replay):
+        ''' Call replay now, then every interval seconds, in the background
+            (once per process)
+        '''
+        with self.lock:
+            if self.replayer and self.replayer.is_alive():
+                return
+            self.replayer = threading.Thread(target=self._replay_loop, args=(interval, replay),
+                                             name='kafka-journal', daemon=True)
+            self.replayer.start()
+
+    def _replay_loop(self, interval, replay):
+        while True:
+            try:
+                replay()
+            except Exception as err:
+                print("Could not replay Kafka journal: %s" % (getattr(err, 'message', err),))
+            sleep(interval)
+
+
+class ResponseCache():
+    ''' Size-bounded LRU cache of serialized response payloads. Only the
+        payload (everything but the rest envelope) is cached; the envelope is
+        rebuilt for each request. Entries expire after their endpoint's TTL
+        and are tagged with the tables they were built from, so they can be
+        invalidated when those tables change.
+    '''
+    # Per-request rest fields that aren't restored from the cache
+    VOLATILE = ['requester', 'url', 'endpoint', 'error', 'elapsed_time', 'user',
+                'query_count']
+
+    def __init__(self, maxbytes):
+        self.maxbytes = maxbytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.stats = {'hits': 0, 'misses': 0, 'not_modified': 0, 'evictions': 0,
+                      'invalidations': 0}
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry['expires'] > time():
+                self.entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return entry
+            if entry:
+                self._remove(key)
+            self.stats['misses'] += 1
+        return None
+
+    def put(self, key, payload, split, rest, ttl, tables):
+        entry = {'payload': payload,
+                 'split': split,
+                 'etag': hashlib.sha1(payload).hexdigest(),
+                 'rest': {key: val for key, val in rest.items()
+                          if key not in ResponseCache.VOLATILE},
+                 'expires': time() + ttl,
+                 'tables': set(tables)}
+        if len(payload) > self.maxbytes:
+            return entry
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            self.entries[key] = entry
+            self.bytes += len(payload)
+            while self.bytes > self.maxbytes:
+                self._remove(next(iter(self.entries)))
+                self.stats['evictions'] += 1
+        return entry
+
+    def _remove(self, key):
+        self.bytes -= len(self.entries.pop(key)['payload'])
+
+    def invalidate(self, table):
+        ''' Drop every entry built from a table '''
+        with self.lock:
+            for key in [key for key, entry in self.entries.items()
+                        if table in entry['tables']]:
+                self._remove(key)
+                self.stats['invalidations'] += 1
+
+    def status(self):
+        with self.lock:
+            retval = {'entries': len(self.entries), 'bytes': self.bytes,
+                      'max_bytes': self.maxbytes}
+            retval.update(self.stats)
+        return retval
+
+
+class UpstreamCache():
+    ''' LRU cache (with a TTL) of upstream query results. Concurrent requests
+        for the same key are coalesced: one of them calls upstream and the
+        others wait for its result.
+    '''
+    def __init__(self, ttl, maxsize):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.inflight = dict()
+        self.stats = {'hits': 0, 'misses': 0, 'coalesced': 0, 'evictions': 0}
+
+    def get(self, key):
+        ''' Return a cached value, or None '''
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry and entry[1] > time():
+                self.entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return entry[0]
+            if entry:
+                del self.entries[key]
+            self.stats['misses'] += 1
+        return None
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def fetch(self, key, loader):
+        ''' Return a cached value, calling loader (once, however many
+            requests are waiting for it) on a miss
+        '''
+        value = self.get(key)
+        if value is not None:
+            return value
+        with self.lock:
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self.inflight[key] = {'done': threading.Event(),
+                                               'value': None, 'error': None}
+            else:
+                self.stats['coalesced'] += 1
+        if not leader:
+            flight['done'].wait()
+            if flight['error']:
+                raise flight['error']
+            return flight['value']
+        try:
+            flight['value'] = loader()
+            self.put(key, flight['value'])
+        except Exception as err:
+            flight['error'] = err
+            raise
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            flight['done'].set()
+        return flight['value']
+
+    def status(self):
+        with self.lock:
+            retval = {'entries': len(self.entries), 'max_entries': self.maxsize,
+                      'in_flight': len(self.inflight)}
+            retval.update(self.stats)
+        return retval
+
+
+class Dependency():
+    ''' An external dependency (configuration, Elasticsearch, Kafka, the CV
+        cache) that's initialized on first use. Concurrent first callers wait
+        for a single initialization instead of racing; a failure is
+        remembered for retry_seconds, so callers fail fast with a 503 while
+        the dependency is down.
+    '''
+    def __init__(self, name, factory, retry_seconds):
+        self.name = name
+        self.factory = factory
+        self.retry_seconds = retry_seconds
+        self.lock = threading.Lock()
+        # Separate from lock, which is held during initialization
+        self.warm_lock = threading.Lock()
+        self.value = None
+        self.ready = False
+        self.error = None
+        self.failed = 0
+        self.init_seconds = None
+        self.warmer = None
+
+    def get(self):
+        if self.ready:
+            return self.value
+        with self.lock:
+            if self.ready:
+                return self.value
+            if self.error and time() - self.failed < self.retry_seconds:
+                raise InvalidUsage("%s is unavailable: %s" % (self.name, self.error), 503)
+            started = time()
+            try:
+                self.value = self.factory()
+            except Exception as err:
+                self.error = str(getattr(err, 'message', err))
+                self.failed = time()
+                print("Could not initialize %s: %s" % (self.name, self.error))
+                raise InvalidUsage("%s is unavailable: %s" % (self.name, self.error), 503)
+            self.init_seconds = time() - started
+            self.error = None
+            self.ready = True
+        return self.value
+
+    def start(self):
+        ''' Initialize in the background, unless that's done or underway '''
+        with self.warm_lock:
+            if self.ready or (self.warmer and self.warmer.is_alive()):
+                return
+            self.warmer = threading.Thread(target=self._warm, name='warm-' + self.name,
+                                           daemon=True)
+            self.warmer.start()
+
+    def _warm(self):
+        try:
+            self.get()
+        except InvalidUsage:
+            pass
+
+    def join(self, timeout):
+        warmer = self.warmer
+        if warmer:
+            warmer.join(timeout)
+
+    def status(self):
+        return {'ready': self.ready, 'error': self.error, 'init_seconds': self.init_seconds}
+
+
+class Metrics():
+    ''' Request metrics for this worker: histograms of latency, time spent in
+        SQL, upstream calls and serialization, and response size, per
+        endpoint. Snapshots are written to a shared directory (one file per
+        worker process) so /metrics can aggregate across gunicorn workers.
+    '''
+    BUCKETS = {'seconds': (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+               'bytes': (1024, 10240, 102400, 1048576, 10485760, 104857600)}
+    HISTOGRAMS = {'request_duration_seconds': 'Request latency',
+                  'sql_duration_seconds': 'Time spent executing SQL',
+                  'upstream_duration_seconds': 'Time spent calling upstream servers',
+                  'serialization_duration_seconds': 'Time spent serializing JSON',
+                  'compression_duration_seconds': 'Time spent compressing responses',
+                  'response_size_bytes': 'Response body size',
+                  'compressed_size_bytes': 'Compressed response body size'}
+
+    def __init__(self, directory, flush_seconds):
+        self.directory = directory
+        self.flush_seconds = flush_seconds
+        self.lock = threading.Lock()
+        self.histograms = dict()
+        self.requests = dict()
+        self.flushed = 0
+
+    def observe(self, metric, endpoint, value):
+        buckets = Metrics.BUCKETS[metric.rsplit('_', 1)[-1]]
+        hist = self.histograms.setdefault('%s|%s' % (metric, endpoint),
+                                          {'buckets': [0] * (len(buckets) + 1),
+                                           'sum': 0, 'count': 0})
+        for idx, bound in enumerate(buckets):
+            if value <= bound:
+                break
+        else:
+            idx = len(buckets)
+        hist['buckets'][idx] += 1
+        hist['sum'] += value
+        hist['count'] += 1
+
+    def record(self, endpoint, status, elapsed, timings, size, compressed=None):
+        ''' Record a finished request '''
+        with self.lock:
+            key = '%s|%s' % (endpoint, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self.observe('request_duration_seconds', endpoint, elapsed)
+            self.observe('sql_duration_seconds', endpoint,
+                         timings.get('execute', 0) + timings.get('fetch', 0))
+            for category in ('upstream', 'serialization', 'compression'):
+                self.observe(category + '_duration_seconds', endpoint,
+                             timings.get(category, 0))
+            if size is not None:
+                self.observe('response_size_bytes', endpoint, size)
+            if compressed is not None:
+                self.observe('compressed_size_bytes', endpoint, compressed)
+        if time() - self.flushed >= self.flush_seconds:
+            self.flush()
+
+    def snapshot(self):
+        with self.lock:
+            return {'histograms': json.loads(json.dumps(self.histograms)),
+                    'requests': dict(self.requests)}
+
+    def flush(self):
+        ''' Write this worker's snapshot to the metrics directory '''
+        self.flushed = time()
+        if not self.directory:
+            return
+        path = os.path.join(self.directory, '%d.json' % (os.getpid(),))
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(path + '.tmp', 'w') as outfile:
+                json.dump(self.snapshot(), outfile)
+            os.replace(path + '.tmp', path)
+        except OSError as err:
+            print("Could not write metrics to %s: %s" % (path, err))
+
+    def collect(self):
+        ''' Return the sum of every worker's snapshot '''
+        if not self.directory:
+            return self.snapshot()
+        self.flush()
+        total = {'histograms': dict(), 'requests': dict()}
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as infile:
+                    snapshot = json.load(infile)
+            except (OSError, ValueError):
+                continue
+            for key, count in snapshot['requests'].items():
+                total['requests'][key] = total['requests'].get(key, 0) + count
+            for key, hist in snapshot['histograms'].items():
+                if key not in total['histograms']:
+                    total['histograms'][key] = hist
+                    continue
+                merged = total['histograms'][key]
+                merged['buckets'] = [a + b for a, b in zip(merged['buckets'], hist['buckets'])]
+                merged['sum'] += hist['sum']
+                merged['count'] += hist['count']
+        return total
+
+    @staticmethod
+    def quantile(hist, buckets, fraction):
+        ''' Estimate a quantile by interpolating within its bucket '''
+        rank = fraction * hist['count']
+        seen = 0
+        for idx, count in enumerate(hist['buckets']):
+            if count and seen + count >= rank:
+                lower = buckets[idx - 1] if idx else 0
+                if idx == len(buckets):
+                    return lower
+                return lower + (buckets[idx] - lower) * (rank - seen) / count
+            seen += count
+        return 0
+
+    def latency(self):
+        ''' Return p50/p95/p99 latency per endpoint for this worker '''
+        retval = dict()
+        buckets = Metrics.BUCKETS['seconds']
+        for key, hist in self.snapshot()['histograms'].items():
+            metric, endpoint = key.split('|', 1)
+            if metric == 'request_duration_seconds' and hist['count']:
+                retval[endpoint] = {'p%d' % (pct,): Metrics.quantile(hist, buckets, pct / 100)
+                                    for pct in (50, 95, 99)}
+        return retval
+
+    def render(self):
+        ''' Return the aggregated metrics in Prometheus text format '''
+        total = self.collect()
+        lines = ['# HELP mad_requests_total Requests handled',
+                 '# TYPE mad_requests_total counter']
+        for key in sorted(total['requests']):
+            endpoint, status = key.split('|', 1)
+            lines.append('mad_requests_total{endpoint="%s",status="%s"} %d'
+                         % (endpoint, status, total['requests'][key]))
+        for metric, description in Metrics.HISTOGRAMS.items():
+            buckets = Metrics.BUCKETS[metric.rsplit('_', 1)[-1]]
+            lines.append('# HELP mad_%s %s' % (metric, description))
+            lines.append('# TYPE mad_%s histogram' % (metric,))
+            for key in sorted(total['histograms']):
+                name, endpoint = key.split('|', 1)
+                if name != metric:
+                    continue
+                hist = total['histograms'][key]
+                cumulative = 0
+                for bound, count in zip(buckets + ('+Inf',), hist['buckets']):
+                    cumulative += count
+                    lines.append('mad_%s_bucket{endpoint="%s",le="%s"} %d'
+                                 % (metric, endpoint, bound, cumulative))
+                lines.append('mad_%s_sum{endpoint="%s"} %s' % (metric, endpoint, hist['sum']))
+                lines.append('mad_%s_count{endpoint="%s"} %d'
+                             % (metric, endpoint, hist['count']))
+        return '\n'.join(lines) + '\n'
+
+
+# *****************************************************************************
+# * App factory                                                               *
+# *****************************************************************************
+
+
+def create_app():
+    ''' Create the Flask app from config.cfg, with any settings in the file
+        named by MAD_RESPONDER_SETTINGS overriding it. Nothing connects to a
+        database or server here: that's done lazily, or by warmup() once a
+        worker has started. The pool, caches and dependencies are module
+        state, so this can only be called once per process (importing
+        mad_responder calls it).
+    '''
+    global app, SPEC
+    if app:
+        raise RuntimeError("create_app can only be called once per process")
+    app = Flask(__name__)
+    app.app_ctx_globals_class = RequestGlobals
+    SPEC = None
+    app.config.from_pyfile("config.cfg")
+    app.config.from_envvar('MAD_RESPONDER_SETTINGS', silent=True)
+    app.config['STARTTIME'] = time()
+    app.config['STARTDT'] = datetime.now()
+    CORS(app)
+    app.register_blueprint(BLUEPRINT)
+    init_state()
+    return app
+
+
+def init_state():
+    ''' (Re)create this process's state (database pool, caches, dependencies
+        and locks) from the app's settings. This is also run in forked
+        children, so that a worker forked from a preloaded parent never
+        shares its connections, sockets or held locks.
+    '''
+    global CONFIG, POOL, CV_CACHE, PROFILE_CACHE, RESPONSE_CACHE, NEUPRINT_CACHE, METRICS, \
+           STATS_LOCK, SESSIONS, SESSION_LOCK, KAFKA_JOURNAL, KAFKA_LOCK, KAFKA_STATS, \
+           DEPENDENCIES
+    CONFIG = {'config': {'url': app.config['CONFIG_ROOT']}}
+    POOL = ConnectionPool(app.config['MYSQL_POOL_MIN'], app.config['MYSQL_POOL_MAX'],
+                          app.config['MYSQL_POOL_TIMEOUT'],
+                          app.config['MYSQL_POOL_IDLE_SECONDS'],
+                          app.config['RECONNECT_SECONDS'],
+                          host=app.config['MYSQL_DATABASE_HOST'],
+                          user=app.config['MYSQL_DATABASE_USER'],
+                          password=app.config['MYSQL_DATABASE_PASSWORD'],
+                          db=app.config['MYSQL_DATABASE_DB'],
+                          cursorclass=CountingCursor)
+    CV_CACHE = CVCache(app.config['CV_CACHE_TTL'])
+    PROFILE_CACHE = ProfileCache(app.config['PROFILE_CACHE_SIZE'])
+    RESPONSE_CACHE = ResponseCache(app.config['RESPONSE_CACHE_BYTES'])
+    NEUPRINT_CACHE = UpstreamCache(app.config['NEUPRINT_CACHE_TTL'],
+                                   app.config['NEUPRINT_CACHE_SIZE'])
+    METRICS = Metrics(app.config['METRICS_DIR'], app.config['METRICS_FLUSH_SECONDS'])
+    STATS_LOCK = threading.Lock()
+    SESSIONS = dict()
+    SESSION_LOCK = threading.Lock()
+    KAFKA_JOURNAL = KafkaJournal(app.config['KAFKA_JOURNAL'], app.config['KAFKA_JOURNAL_MAX'])
+    KAFKA_LOCK = threading.Lock()
+    KAFKA_STATS = {'sent': 0, 'delivered': 0, 'failed': 0, 'spilled': 0,
+                   'dropped': 0, 'replayed': 0}
+    DEPENDENCIES = {name: Dependency(name, factory, app.config['DEPENDENCY_RETRY_SECONDS'])
+                    for name, factory in (('config', load_config),
+                                          ('elasticsearch', connect_elasticsearch),
+                                          ('kafka', connect_kafka),
+                                          ('cv_cache', load_cv_cache))}
+
+
+def after_fork():
+    if app:
+        init_state()
+
+
+def flush_metrics():
+    if app:
+        METRICS.flush()
+
+
+os.register_at_fork(after_in_child=after_fork)
+atexit.register(flush_metrics)
+
 # *****************************************************************************
 # * Flask                                                                     *
 # *****************************************************************************
 
 
-@app.before_request
+@BLUEPRINT.before_app_request
 def before_request():
-    global START_TIME, CVTERMS, CONFIG, ESEARCH, SERVER, PRODUCER
-    START_TIME = time()
-    g.db = conn
-    g.c = cursor
-    app.config['COUNTER'] += 1
-    endpoint = request.endpoint if request.endpoint else '(Unknown)'
-    app.config['ENDPOINTS'][endpoint] = app.config['ENDPOINTS'].get(endpoint, 0) + 1
+    g.start_time = time()
+    g.timings = dict()
+    g.idcolumn = 0
+    endpoint = endpoint_name() or '(Unknown)'
+    with STATS_LOCK:
+        app.config['COUNTER'] += 1
+        app.config['ENDPOINTS'][endpoint] = app.config['ENDPOINTS'].get(endpoint, 0) + 1
     if request.method == 'OPTIONS':
         result = initialize_result()
         return generate_response(result)
-    if not SERVER:
-        data = call_responder('config', 'config/rest_services')
-        CONFIG = data['config']
-        data = call_responder('config', 'config/servers')
-        SERVER = data['config']
-        try:
-            ESEARCH = elasticsearch.Elasticsearch(SERVER['elk-elastic']['address'])
-        except Exception as ex: # pragma: no cover
-            template = "An exception of type {0} occurred. Arguments:\n{1!r}"
-            message = template.format(type(ex).__name__, ex.args)
-            print(message)
-            sys.exit(-1)
-        PRODUCER = KafkaProducer(bootstrap_servers=SERVER['Kafka']['broker_list'])
-        try:
-            g.c.execute('SELECT cv,cv_term,id FROM cv_term_vw ORDER BY 1,2')
-            rows = g.c.fetchall()
-            for row in rows:
-                if row['cv'] not in CVTERMS:
-                    CVTERMS[row['cv']] = dict()
-                CVTERMS[row['cv']][row['cv_term']] = row['id']
-        except Exception as err:
-            raise InvalidUsage(sql_error(err), 500)
+    if not DEPENDENCIES['cv_cache'].ready:
+        # Until the CV cache is loaded, CV endpoints fall back to SQL
+        DEPENDENCIES['cv_cache'].start()
+    if request.method == 'GET' and endpoint in app.config['CACHED_ENDPOINTS'] \
+       and not streaming_requested():
+        # The format can come from the Accept header, so it's part of the key
+        g.cache_key = (endpoint, tuple(sorted((request.view_args or {}).items())),
+                       tuple(sorted(parse_qsl(request.query_string.decode('utf-8'),
+                                              keep_blank_values=True))),
+                       response_format())
+        entry = RESPONSE_CACHE.get(g.cache_key)
+        if entry:
+            result = initialize_result()
+            result['rest'].update(entry['rest'])
+            result['rest']['response_cached'] = True
+            return cached_response(result, entry)
+
+
+@BLUEPRINT.after_app_request
+def after_request(response):
+    g.status = response.status_code
+    if g.get('negotiated'):
+        response.vary.add('Accept')
+    if not response.is_streamed:
+        g.response_size = response.calculate_content_length()
+    return compress_response(response)
+
+
+@BLUEPRINT.teardown_app_request
+def teardown_request(exception):
+    cursor = g.pop('c', None)
+    if cursor:
+        cursor.close()
+    dbc = g.pop('db', None)
+    if dbc:
+        POOL.put(dbc)
+    if 'timings' in g:
+        METRICS.record(endpoint_name() or '(Unknown)',
+                       g.get('status', 500), time() - g.start_time, g.timings,
+                       g.get('response_size'), g.get('compressed_size'))
+
+
+# ******************************************************************************
+# * Dependencies                                                               *
+# ******************************************************************************
+
+
+def load_config():
+    return {'rest_services': call_responder('config', 'config/rest_services')['config'],
+            'servers': call_responder('config', 'config/servers')['config']}
+
+
+def connect_elasticsearch():
+    import elasticsearch
+    return elasticsearch.Elasticsearch(server_config('elk-elastic')['address'])
+
+
+def connect_kafka():
+    from kafka import KafkaProducer
+    producer = KafkaProducer(bootstrap_servers=server_config('Kafka')['broker_list'],
+                             linger_ms=app.config['KAFKA_LINGER_MS'],
+                             compression_type=app.config['KAFKA_COMPRESSION'],
+                             max_block_ms=app.config['KAFKA_MAX_BLOCK_MS'])
+    atexit.register(producer.close, 10)
+    return producer
+
+
+def load_cv_cache():
+    dbc = POOL.get()
+    try:
+        cursor = dbc.cursor()
+        CV_CACHE.refresh(cursor)
+        cursor.close()
+    finally:
+        POOL.put(dbc)
+    CV_CACHE.start()
+    return CV_CACHE
+
+
+def service_config(server):
+    ''' Return a server's entry in the config system's rest_services '''
+    if server == 'config':
+        return CONFIG['config']
+    return DEPENDENCIES['config'].get()['rest_services'][server]
+
+
+def server_config(server):
+    ''' Return a server's entry in the config system's servers '''
+    return DEPENDENCIES['config'].get()['servers'][server]
+
+
+def build_spec():
+    ''' Build the Swagger spec from the endpoints' docstrings '''
+    from flask_swagger import swagger
+    swag = swagger(app)
+    swag['info']['version'] = __version__
+    swag['info']['title'] = "MAD Responder"
+    return swag
+
+
+def get_spec():
+    ''' Return the serialized Swagger spec (plain and gzipped) and its ETag.
+        It's built once per process, or read from SPEC_FILE if that was
+        written for this version.
+    '''
+    global SPEC
+    if SPEC:
+        return SPEC
+    with SPEC_LOCK:
+        if SPEC:
+            return SPEC
+        swag = None
+        if app.config['SPEC_FILE'] and os.path.exists(app.config['SPEC_FILE']):
+            with open(app.config['SPEC_FILE']) as infile:
+                swag = json.load(infile)
+            if swag.get('info', dict()).get('version') != __version__:
+                print("Ignoring %s: it's for a different version" % (app.config['SPEC_FILE'],))
+                swag = None
+        if not swag:
+            swag = build_spec()
+        body = dumps(swag) + b'\n'
+        SPEC = {'json': body,
+                'gzip': gzip.compress(body, 9, mtime=0),
+                'etag': hashlib.sha1(body).hexdigest()}
+    return SPEC
+
+
+def write_spec(path):
+    ''' Write the Swagger spec to a file, for SPEC_FILE '''
+    with open(path, 'w') as outfile:
+        json.dump(build_spec(), outfile, default=json_default, sort_keys=True)
+    print("Wrote Swagger spec to %s" % (path,))
+
+
+def warmup(timeout=None):
+    ''' Initialize every dependency in parallel, waiting at most timeout
+        (default STARTUP_TIMEOUT) seconds. Called once per worker at startup;
+        anything that isn't ready by then keeps initializing in the
+        background, or on first use. This also starts replaying the Kafka
+        journal every KAFKA_REPLAY_SECONDS.
+    '''
+    if timeout is None:
+        timeout = app.config['STARTUP_TIMEOUT']
+    deadline = time() + timeout
+    # Everything else needs the configuration
+    DEPENDENCIES['config'].start()
+    DEPENDENCIES['config'].join(timeout)
+    for dependency in DEPENDENCIES.values():
+        dependency.start()
+    get_spec()
+    for dependency in DEPENDENCIES.values():
+        dependency.join(max(0, deadline - time()))
+    KAFKA_JOURNAL.start(app.config['KAFKA_REPLAY_SECONDS'], replay_kafka_journal)
+    return {name: dependency.status() for name, dependency in DEPENDENCIES.items()}
 
 
 # ******************************************************************************
@@ -125,39 +1191,128 @@ def before_request():
 # ******************************************************************************
 
 
-def call_profile (token):
+def endpoint_name():
+    ''' Return the request's endpoint name, without the blueprint prefix '''
+    return request.endpoint.rsplit('.', 1)[-1] if request.endpoint else None
+
+
+def add_timing(category, started):
+    ''' Charge the time since started to one of the request's timings '''
+    if has_request_context() and 'timings' in g:
+        g.timings[category] = g.timings.get(category, 0) + time() - started
+
+
+def get_session(server):
+    ''' Return the pooled HTTP session (and circuit breaker) for an upstream
+        server, creating them on first use
+    '''
+    import requests
+    with SESSION_LOCK:
+        if server not in SESSIONS:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                    pool_maxsize=app.config['HTTP_POOL_SIZE'])
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            SESSIONS[server] = (session,
+                                CircuitBreaker(app.config['CIRCUIT_BREAKER_THRESHOLD'],
+                                               app.config['CIRCUIT_BREAKER_RESET']))
+        return SESSIONS[server]
+
+
+def http_request(server, url, headers=None, payload='', idempotent=False):
+    ''' GET (or POST, if there's a payload) a URL on an upstream server.
+        Connection errors, timeouts and 502/503/504 responses are retried with
+        exponential backoff, for GETs and POSTs the caller marks idempotent;
+        when retries are exhausted (or the server's circuit breaker is open) a
+        503 is raised.
+    '''
+    import requests
+    session, breaker = get_session(server)
+    if not breaker.allow():
+        raise InvalidUsage("Upstream server %s is unavailable" % (server,), 503)
+    timeout = (app.config['HTTP_CONNECT_TIMEOUT'], app.config['HTTP_READ_TIMEOUT'])
+    retries = app.config['HTTP_RETRIES'] if idempotent or not payload else 0
+    for attempt in range(retries + 1):
+        started = time()
+        try:
+            if payload:
+                req = session.post(url, headers=headers, json=payload, timeout=timeout)
+            else:
+                req = session.get(url, headers=headers, timeout=timeout)
+        except requests.exceptions.RequestException as err:
+            error = str(err)
+        else:
+            if req.status_code not in (502, 503, 504):
+                breaker.success()
+                return req
+            error = "HTTP %d" % (req.status_code,)
+        finally:
+            add_timing('upstream', started)
+        if attempt < retries:
+            sleep(app.config['HTTP_BACKOFF'] * (2 ** attempt))
+    breaker.failure()
+    print("Could not get response from %s: %s" % (url, error))
+    raise InvalidUsage("Could not get response from %s: %s" % (server, error), 503)
+
+
+def call_profile(token):
     server = 'neuprint'
-    url = CONFIG[server]['url'] + 'profile'
+    url = service_config(server)['url'] + 'profile'
     url = url.replace('/api', '')
     headers = {"Content-Type": "application/json",
                "Authorization": "Bearer " + token}
-    try:
-        req = requests.get(url, headers=headers)
-    except requests.exceptions.RequestException as err: # pragma no cover
-        print(err)
-        sys.exit(-1)
+    req = http_request(server, url, headers)
     if req.status_code == 200:
         return req.json()
     elif req.status_code == 401:
         raise InvalidUsage("Please provide a valid Auth Token", 401)
     else:
-        print("Could not get response from %s" % (url))
-        print(req)
-        sys.exit(-1)
+        print("Could not get response from %s: %s" % (url, req.text))
+        raise InvalidUsage("Could not get profile from %s" % (server,), 503)
 
 
-def call_responder(server, endpoint, payload=''):
-    url = CONFIG[server]['url'] + endpoint
+def get_profile(token):
+    ''' Return the neuPrint profile for a bearer token. Profiles are cached
+        until the token expires (or for at most PROFILE_CACHE_TTL seconds).
+        If JWT_SECRET is configured, tokens are verified locally and profiles
+        are built from their claims without calling neuPrint.
+    '''
+    profile = PROFILE_CACHE.get(token)
+    if profile:
+        return profile
+    expires = time() + app.config['PROFILE_CACHE_TTL']
+    secret = app.config['JWT_SECRET']
     try:
-        if payload:
-            headers = {"Content-Type": "application/json",
-                       "Authorization": "Bearer " + app.config['BEARER']}
-            req = requests.post(url, headers=headers, json=payload)
+        if secret:
+            claims = decode(token, secret, algorithms=app.config['JWT_ALGORITHMS'])
         else:
-            req = requests.get(url)
-    except requests.exceptions.RequestException as err: # pragma no cover
-        print(err)
-        sys.exit(-1)
+            claims = decode(token, options={'verify_signature': False})
+    except InvalidTokenError:
+        if secret:
+            raise InvalidUsage("Please provide a valid Auth Token", 401)
+        claims = dict()
+    if 'exp' in claims:
+        expires = min(expires, claims['exp'])
+    if secret and 'image-url' in claims:
+        profile = {'Email': claims.get('email', ''),
+                   'ImageURL': claims['image-url'],
+                   'AuthLevel': claims.get('level', '')}
+        with PROFILE_CACHE.lock:
+            PROFILE_CACHE.stats['verified_locally'] += 1
+    else:
+        profile = call_profile(token)
+    PROFILE_CACHE.put(token, profile, expires)
+    return profile
+
+
+def call_responder(server, endpoint, payload='', idempotent=False):
+    url = service_config(server)['url'] + endpoint
+    headers = None
+    if payload:
+        headers = {"Content-Type": "application/json",
+                   "Authorization": "Bearer " + g.get('bearer', '')}
+    req = http_request(server, url, headers, payload, idempotent)
     if req.status_code == 200:
         return req.json()
     else:
@@ -179,21 +1334,23 @@ def sql_error(err):
 def initialize_result():
     result = {"rest": {'requester': request.remote_addr,
                        'url': request.url,
-                       'endpoint': request.endpoint,
+                       'endpoint': endpoint_name(),
                        'error': False,
                        'elapsed_time': '',
                        'row_count': 0}}
     if 'Authorization' in  request.headers:
         token = re.sub(r'Bearer\s+', '', request.headers['Authorization'])
         dtok = dict()
-        app.config['BEARER'] = token
-        dtok = call_profile(token)
+        g.bearer = token
+        started = time()
+        dtok = get_profile(token)
+        add_timing('auth', started)
         result['rest']['user'] = dtok['ImageURL']
-        app.config['USERS'][dtok['ImageURL']] = app.config['USERS'].get(dtok['ImageURL'], 0) + 1
-    elif request.method in ['DELETE', 'POST'] or request.endpoint in app.config['REQUIRE_AUTH']:
+        with STATS_LOCK:
+            app.config['USERS'][dtok['ImageURL']] = \
+                app.config['USERS'].get(dtok['ImageURL'], 0) + 1
+    elif request.method in ['DELETE', 'POST'] or endpoint_name() in app.config['REQUIRE_AUTH']:
         raise InvalidUsage('You must authorize to use this endpoint', 401)
-    if app.config['LAST_TRANSACTION'] and time() - app.config['LAST_TRANSACTION'] >= app.config['RECONNECT_SECONDS']:
-        g.db.ping()
     app.config['LAST_TRANSACTION'] = time()
     return result
 
@@ -221,17 +1378,63 @@ def add_key_value_pair(key, val, separator, sql, bind):
     return sql, bind
 
 
-def generate_sql(result, sql, query=False):
+def page_parameters(result, ipd, stream=False):
+    ''' Validate the _limit, _offset and _after paging keys and record them
+        in the rest envelope. If no limit was given, PAGE_SIZE_DEFAULT is used;
+        no more than PAGE_SIZE_MAX rows are ever returned. Streamed results
+        are only limited if the caller asks for it.
+    '''
+    try:
+        limit = None if stream else app.config['PAGE_SIZE_DEFAULT']
+        if '_limit' in ipd:
+            limit = int(ipd['_limit'][0])
+        offset = int(ipd['_offset'][0]) if '_offset' in ipd else 0
+    except ValueError:
+        raise InvalidUsage('_limit and _offset must be integers')
+    if (limit is not None and limit < 1) or offset < 0:
+        raise InvalidUsage('_limit must be positive and _offset can not be negative')
+    if not stream:
+        limit = min(limit, app.config['PAGE_SIZE_MAX'])
+    after = ipd['_after'][0] if '_after' in ipd else None
+    if after is not None and '_sort' in ipd:
+        raise InvalidUsage('_after can not be combined with _sort')
+    if limit:
+        result['rest']['limit'] = limit
+    if offset:
+        result['rest']['offset'] = offset
+    if after is not None:
+        result['rest']['after'] = after
+    return limit, offset, after
+
+
+def paginate_result(result, rows, columns=None):
+    ''' If a full page was returned, tell the caller where the next one
+        starts: an _after cursor (the last ID) for keyset paging, or an
+        _offset otherwise. If columns are given, rows are tuples.
+    '''
+    limit = result['rest'].get('limit')
+    if not limit or len(rows) < limit:
+        return
+    if 'after' not in result['rest']:
+        result['rest']['next_offset'] = result['rest'].get('offset', 0) + limit
+    elif columns is None and 'id' in rows[-1]:
+        result['rest']['next'] = rows[-1]['id']
+    elif columns and 'id' in columns:
+        result['rest']['next'] = rows[-1][columns.index('id')]
+
+
+def generate_sql(result, sql, query=False, stream=False):
+    started = time()
     bind = ()
-    global IDCOLUMN
-    IDCOLUMN = 0
+    g.idcolumn = 0
     query_string = 'id='+str(query) if query else request.query_string
     order = ''
+    ipd = dict()
+    separator = ' AND' if ' WHERE ' in sql else ' WHERE'
     if query_string:
         if not isinstance(query_string, str):
             query_string = query_string.decode('utf-8')
         ipd = parse_qs(query_string)
-        separator = ' AND' if ' WHERE ' in sql else ' WHERE'
         for key, val in ipd.items():
             if key == '_sort':
                 order = ' ORDER BY ' + val[0]
@@ -239,22 +1442,130 @@ def generate_sql(result, sql, query=False):
                 sql = sql.replace('*', val[0])
                 varr = val[0].split(',')
                 if 'id' in varr:
-                    IDCOLUMN = 1
+                    g.idcolumn = 1
             elif key == '_distinct':
                 if 'DISTINCT' not in sql:
                     sql = sql.replace('SELECT', 'SELECT DISTINCT')
+            elif key in CONTROL_KEYS:
+                continue
             else:
                 sql, bind = add_key_value_pair(key, val, separator, sql, bind)
                 separator = ' AND'
+    limit, offset, after = page_parameters(result, ipd, stream)
+    if after is not None:
+        sql += separator + ' id>%s'
+        bind = bind + (after,)
+        order = ' ORDER BY id'
+    elif not order and (limit or offset):
+        # Without an order, consecutive pages can overlap or skip rows. Order
+        # by ID, or by every selected column if the ID isn't selected.
+        selected = re.match(r'SELECT (?:DISTINCT )?(.*?) FROM', sql).group(1)
+        if selected == '*' or 'id' in [col.strip() for col in selected.split(',')]:
+            order = ' ORDER BY id'
+        else:
+            order = ' ORDER BY ' + selected
     sql += order
+    if limit:
+        sql += ' LIMIT %d' % (limit,)
+    elif offset:
+        # MySQL needs a LIMIT to use OFFSET
+        sql += ' LIMIT 18446744073709551615'
+    if offset:
+        sql += ' OFFSET %d' % (offset,)
     if bind:
         result['rest']['sql_statement'] = sql % bind
     else:
         result['rest']['sql_statement'] = sql
+    add_timing('sql_generation', started)
     return sql, bind
 
 
-def execute_sql(result, sql, container, query=False):
+def streaming_requested():
+    ''' Did the caller ask for rows to be streamed as NDJSON? '''
+    if request.args.get('_stream', '').lower() in ['1', 'true']:
+        return True
+    return request.accept_mimetypes.best_match(['application/json', NDJSON]) == NDJSON
+
+
+def response_format():
+    ''' Return the row format the caller asked for with _format, or with an
+        Accept header naming one of the export formats (in which case the
+        response varies on Accept)
+    '''
+    if '_format' in request.args:
+        fmt = request.args['_format'].lower()
+        if fmt not in FORMATS:
+            raise InvalidUsage('_format must be one of: ' + ', '.join(FORMATS))
+    else:
+        g.negotiated = True
+        best = request.accept_mimetypes.best_match(['application/json']
+                                                   + list(EXPORT_MIMETYPES.values()))
+        fmt = {mimetype: fmt for fmt, mimetype in EXPORT_MIMETYPES.items()}.get(best, 'json')
+    if fmt in ('arrow', 'parquet') and not find_spec('pyarrow'):
+        raise InvalidUsage('Exporting to %s needs pyarrow, which is not installed' % (fmt,), 406)
+    return fmt
+
+
+def stream_sql(result, sql, container, query=False, tuples=False):
+    ''' Execute a query with an unbuffered cursor and put a generator of its
+        rows in the result, so they can be streamed to the caller without
+        being held in memory. If tuples is set, rows are tuples and their
+        column names are put in result['columns'].
+    '''
+    sql, bind = generate_sql(result, sql, query, stream=True)
+    cursor = g.db.cursor(pymysql.cursors.SSCursor if tuples else pymysql.cursors.SSDictCursor)
+    started = time()
+    try:
+        g.c.statements += 1
+        cursor.execute(sql, bind or None)
+        add_timing('execute', started)
+        started = time()
+        first = cursor.fetchone()
+    except Exception as err:
+        cursor.close()
+        raise InvalidUsage(sql_error(err), 500)
+    finally:
+        add_timing('fetch', started)
+    if first is None:
+        cursor.close()
+        raise InvalidUsage("No rows returned for query %s" % (sql,), 404)
+    if tuples:
+        result['columns'] = [desc[0] for desc in cursor.description]
+    result[container] = stream_rows(cursor, first)
+    return 1
+
+
+def stream_rows(cursor, first):
+    finished = False
+    try:
+        yield first
+        for row in cursor:
+            yield row
+        finished = True
+    finally:
+        if finished:
+            cursor.close()
+        else:
+            # The caller went away: closing the cursor would read the rest of
+            # the result set, so drop the connection instead (the pool
+            # discards it when it's returned).
+            g.db.close()
+
+
+def execute_sql(result, sql, container, query=False, raw=False):
+    ''' Execute a query and put its rows in result[container]. If raw is set,
+        the rows are returned to the caller as is, so they may be streamed
+        if the caller asked for it.
+    '''
+    fmt = response_format() if raw else 'json'
+    if fmt in ('csv', 'tsv'):
+        return stream_sql(result, sql, container, query, tuples=True)
+    if fmt != 'json':
+        if streaming_requested():
+            raise InvalidUsage('_format=%s can not be streamed' % (fmt,))
+        return execute_columnar(result, sql, container, query)
+    if raw and streaming_requested():
+        return stream_sql(result, sql, container, query)
     sql, bind = generate_sql(result, sql, query)
     if app.config['DEBUG']: # pragma: no cover
         if bind:
@@ -266,17 +1577,53 @@ def execute_sql(result, sql, container, query=False):
             g.c.execute(sql, bind)
         else:
             g.c.execute(sql)
+        started = time()
         rows = g.c.fetchall()
+        add_timing('fetch', started)
     except Exception as err:
         raise InvalidUsage(sql_error(err), 500)
     result[container] = []
     if rows:
         result[container] = rows
         result['rest']['row_count'] = len(rows)
+        paginate_result(result, rows)
         return 1
     raise InvalidUsage("No rows returned for query %s" % (sql,), 404)
 
 
+def execute_columnar(result, sql, container, query=False):
+    ''' Execute a query with a tuple cursor and return its rows without
+        building a dict per row: for _format=columns, as {column: [values]}
+        in result[container]; otherwise as result['columns'] and
+        result['rows'] (one tuple per row).
+    '''
+    sql, bind = generate_sql(result, sql, query)
+    cursor = g.db.cursor(pymysql.cursors.Cursor)
+    started = time()
+    try:
+        g.c.statements += 1
+        cursor.execute(sql, bind or None)
+        add_timing('execute', started)
+        started = time()
+        rows = cursor.fetchall()
+        add_timing('fetch', started)
+        columns = [desc[0] for desc in cursor.description]
+    except Exception as err:
+        raise InvalidUsage(sql_error(err), 500)
+    finally:
+        cursor.close()
+    if not rows:
+        raise InvalidUsage("No rows returned for query %s" % (sql,), 404)
+    result['rest']['row_count'] = len(rows)
+    paginate_result(result, rows, columns)
+    if response_format() == 'columns':
+        result[container] = dict(zip(columns, zip(*rows)))
+    else:
+        result['columns'] = columns
+        result['rows'] = rows
+    return 1
+
+
 def show_columns(result, table):
     result['columns'] = []
     try:
@@ -290,52 +1637,182 @@ def show_columns(result, table):
         raise InvalidUsage(sql_error(err), 500)
 
 
-def get_additional_cv_data(sid):
-    sid = str(sid)
-    g.c.execute(SQL['CVREL'], (sid, sid))
-    cvrel = g.c.fetchall()
-    return cvrel
+def cached_match(value, operator, target):
+    ''' Evaluate one generate_sql filter against a cached value the way MySQL
+        would. Raises ValueError for comparisons that must be left to SQL.
+    '''
+    if isinstance(value, bool) or not isinstance(value, (int, str, type(None))):
+        raise ValueError(target)
+    if '*' in target:
+        if operator not in ('', '!'):
+            raise ValueError(target)
+        if value is None:
+            return False
+        pattern = re.escape(target).replace(r'\*', '.*').replace('_', '.')
+        return bool(re.match('^' + pattern + '$', str(value), re.I | re.S)) \
+               != (operator == '!')
+    if isinstance(value, int) or (operator in ('>', '<')):
+        if not isinstance(value, (int, type(None))):
+            raise ValueError(target)
+        target = int(target)
+    if value is None:
+        return False
+    if isinstance(value, str):
+        # Default MySQL collations are case-insensitive and ignore trailing
+        # spaces
+        value, target = value.rstrip(' ').casefold(), target.rstrip(' ').casefold()
+    if operator == '!':
+        return value != target
+    if operator == '>':
+        return value >= target
+    if operator == '<':
+        return value <= target
+    return value == target
+
+
+def cached_sort_key(value):
+    if value is None:
+        return (0,)
+    return (1, value.casefold() if isinstance(value, str) else value)
+
+
+def execute_cached(result, table, container, query=False, columns='*'):
+    ''' Serve a query on a table held in CV_CACHE from memory, falling back
+        to execute_sql if it can't be answered from the cache
+    '''
+    query_string = 'id='+str(query) if query else request.query_string
+    if not isinstance(query_string, str):
+        query_string = query_string.decode('utf-8')
+    selected = CV_CACHE.select(result, table, query_string, columns)
+    if selected is None:
+        return execute_sql(result, 'SELECT %s FROM %s' % (columns, table), container, query)
+    rows, g.idcolumn = selected
+    result[container] = []
+    result['rest']['cached'] = True
+    if rows:
+        result[container] = rows
+        result['rest']['row_count'] = len(rows)
+        paginate_result(result, rows)
+        return 1
+    raise InvalidUsage("No rows returned for query on %s" % (table,), 404)
+
+
+def group_relationships(rels, members=None):
+    ''' Group relationship rows by subject and object ID. If members is given,
+        only IDs in members are kept.
+    '''
+    relationships = dict()
+    for rel in rels:
+        entry = {'subject': rel['subject'],
+                 'relationship': rel['relationship'],
+                 'object': rel['object']}
+        for sid in {rel['subject_id'], rel['object_id']}:
+            if members is None or sid in members:
+                relationships.setdefault(sid, []).append(entry)
+    return relationships
+
+
+def get_relationships(stmt, rows):
+    ''' Fetch relationships for all rows in as few queries as possible and
+        return them grouped by subject/object ID
+    '''
+    relationships = dict()
+    ids = list(dict.fromkeys([row['id'] for row in rows]))
+    chunk_size = app.config['RELATIONSHIP_CHUNK_SIZE']
+    for start in range(0, len(ids), chunk_size):
+        chunk = ids[start:start+chunk_size]
+        marks = ','.join(['%s'] * len(chunk))
+        g.c.execute(SQL[stmt] % (marks, marks), tuple(chunk) * 2)
+        # A relationship is reported for each end that's in this chunk; ends
+        # in other chunks pick it up when their chunk is queried.
+        for sid, entries in group_relationships(g.c.fetchall(), set(chunk)).items():
+            relationships.setdefault(sid, []).extend(entries)
+    return relationships
 
 
 def get_cv_data(result, cvs):
+    started = time()
     result['data'] = []
     try:
+        relationships = dict()
+        if result['rest'].get('cached'):
+            relationships = CV_CACHE.relationships('cv')
+        elif not g.idcolumn:
+            relationships = get_relationships('CVREL', [col for col in cvs if 'id' in col])
         for col in cvs:
             tcv = col
-            if ('id' in col) and (not IDCOLUMN):
-                cvrel = get_additional_cv_data(col['id'])
-                tcv['relationships'] = list(cvrel)
+            if ('id' in col) and (not g.idcolumn):
+                tcv['relationships'] = relationships.get(col['id'], [])
             result['data'].append(tcv)
     except Exception as err:
         raise InvalidUsage(sql_error(err), 500)
-
-
-def get_additional_cv_term_data(sid):
-    sid = str(sid)
-    g.c.execute(SQL['CVTERMREL'], (sid, sid))
-    cvrel = g.c.fetchall()
-    return cvrel
+    finally:
+        add_timing('enrichment', started)
 
 
 def get_cv_term_data(result, cvterms):
+    started = time()
     result['data'] = []
     try:
+        relationships = dict()
+        if result['rest'].get('cached'):
+            relationships = CV_CACHE.relationships('cv_term_vw')
+        elif not g.idcolumn:
+            relationships = get_relationships('CVTERMREL',
+                                              [col for col in cvterms if 'id' in col])
         for col in cvterms:
             cvterm = col
-            if ('id' in col) and (not IDCOLUMN):
-                cvtermrel = get_additional_cv_term_data(col['id'])
-                cvterm['relationships'] = list(cvtermrel)
+            if ('id' in col) and (not g.idcolumn):
+                cvterm['relationships'] = relationships.get(col['id'], [])
             result['data'].append(cvterm)
     except Exception as err:
         raise InvalidUsage(sql_error(err), 500)
+    finally:
+        add_timing('enrichment', started)
+
+
+def lookup_term_id(cv_cache, cv, term):
+    ''' Return a CV term's ID. A term that isn't in the CV cache (which may be
+        empty after a failed refresh, or not yet have a term another worker
+        added) is looked up in cv_term_vw, and the cache is refreshed.
+    '''
+    type_id = cv_cache.term_id(cv, term)
+    if type_id:
+        return type_id
+    g.c.execute('SELECT id FROM cv_term_vw WHERE cv=%s AND cv_term=%s', (cv, term))
+    row = g.c.fetchone()
+    if not row:
+        return None
+    cv_cache.refresh_soon()
+    return row['id']
+
+
+def refresh_cv_cache():
+    ''' Reload CV_CACHE after a CV or CV term was added. The write is already
+        committed, so a failure is logged rather than returned to the caller.
+    '''
+    try:
+        CV_CACHE.refresh(g.c)
+    except Exception as err:
+        print("Could not refresh CV cache: %s" % (getattr(err, 'message', err),))
+        CV_CACHE.invalidate()
 
 
 def update_property(result, proptype):
+    ''' Add a property from the request's form or JSON object. A JSON array
+        or an NDJSON body is inserted in bulk by insert_properties.
+    '''
+    if request.mimetype == NDJSON:
+        insert_properties(result, proptype, ndjson_entries(request.stream))
+        return
     ipd = dict()
     if request.form:
-        result['rest']['form'] = request.form
+        result['rest']['form'] = request.form.to_dict()
         for i in request.form:
             ipd[i] = request.form[i]
+    elif isinstance(request.json, list):
+        insert_properties(result, proptype, request.json)
+        return
     elif request.json:
         result['rest']['json'] = request.json
         ipd = request.json
@@ -355,40 +1832,629 @@ def update_property(result, proptype):
         raise InvalidUsage(sql_error(err), 500)
     if len(rows) != 1:
         raise InvalidUsage(('Could not find %s ID %s' % (proptype, ipd['id'])), 404)
-    if ipd['cv'] in CVTERMS and ipd['term'] in CVTERMS[ipd['cv']]:
+    try:
+        type_id = lookup_term_id(DEPENDENCIES['cv_cache'].get(), ipd['cv'], ipd['term'])
+    except Exception as err:
+        raise InvalidUsage(sql_error(err), 500)
+    if type_id:
         sql = 'INSERT INTO %s_property (%s_id,type_id,value) ' % (proptype, proptype)
         sql += 'VALUES(%s,%s,%s)'
-        bind = (ipd['id'], CVTERMS[ipd['cv']][ipd['term']], ipd['value'],)
+        bind = (ipd['id'], type_id, ipd['value'],)
         result['rest']['sql_statement'] = sql % bind
         try:
             g.c.execute(sql, bind)
             result['rest']['row_count'] = g.c.rowcount
             result['rest']['inserted_id'] = g.c.lastrowid
             g.db.commit()
+            RESPONSE_CACHE.invalidate(proptype)
             return
         except Exception as err:
             raise InvalidUsage(sql_error(err), 500)
     raise InvalidUsage(('Could not find CV/term %s/%s' % (ipd['cv'], ipd['term'])), 404)
 
 
+def ndjson_entries(stream):
+    ''' Yield the objects in an NDJSON body. A line that isn't valid JSON is
+        yielded as an InvalidUsage, so it can be reported with its row.
+    '''
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError as err:
+            yield InvalidUsage('Invalid JSON: %s' % (err,))
+
+
+def insert_properties(result, proptype, entries):
+    ''' Insert {id, cv, term, value} entries as properties, in one
+        transaction. Parent IDs are checked and rows inserted
+        PROPERTY_CHUNK_SIZE at a time. Entries that can't be inserted are
+        reported (by 0-based row) and don't stop the load.
+    '''
+    sql = 'INSERT INTO %s_property (%s_id,type_id,value) ' % (proptype, proptype)
+    sql += 'VALUES(%s,%s,%s)'
+    cv_cache = DEPENDENCIES['cv_cache'].get()
+    chunk_size = app.config['PROPERTY_CHUNK_SIZE']
+    inserted = 0
+    errors = []
+    chunk = []
+    terms = dict()
+    try:
+        for row, entry in enumerate(entries):
+            if isinstance(entry, InvalidUsage):
+                errors.append({'row': row, 'error': entry.message})
+                continue
+            if not isinstance(entry, dict):
+                errors.append({'row': row, 'error': 'Entry must be an object'})
+                continue
+            missing = [key for key in ('id', 'cv', 'term', 'value') if key not in entry]
+            if missing:
+                errors.append({'row': row, 'error': 'Missing arguments: ' + ' '.join(missing)})
+                continue
+            key = (entry['cv'], entry['term'])
+            if key not in terms:
+                terms[key] = lookup_term_id(cv_cache, *key)
+            type_id = terms[key]
+            if not type_id:
+                errors.append({'row': row, 'id': entry['id'],
+                               'error': 'Could not find CV/term %s/%s'
+                                        % (entry['cv'], entry['term'])})
+                continue
+            chunk.append((row, entry['id'], type_id, entry['value']))
+            if len(chunk) >= chunk_size:
+                inserted += insert_property_chunk(proptype, sql, chunk, errors)
+                chunk = []
+        if chunk:
+            inserted += insert_property_chunk(proptype, sql, chunk, errors)
+        g.db.commit()
+    except Exception as err:
+        g.db.rollback()
+        raise InvalidUsage(sql_error(err), 500)
+    if inserted:
+        RESPONSE_CACHE.invalidate(proptype)
+    errors.sort(key=itemgetter('row'))
+    result['rest']['row_count'] = inserted
+    result['rest']['inserted'] = inserted
+    result['rest']['rejected'] = len(errors)
+    result['data'] = errors
+
+
+def insert_property_chunk(proptype, sql, chunk, errors):
+    ''' Insert a chunk of (row, parent ID, type ID, value) tuples whose
+        parents exist, adding an error for the rest. Returns the number of
+        rows inserted.
+    '''
+    ids = sorted({str(parent) for _, parent, _, _ in chunk})
+    g.c.execute('SELECT id FROM %s WHERE id IN (%s)'
+                % (proptype, ','.join(['%s'] * len(ids))), ids)
+    found = {str(row['id']) for row in g.c.fetchall()}
+    bind = []
+    for row, parent, type_id, value in chunk:
+        if str(parent) in found:
+            bind.append((parent, type_id, value))
+        else:
+            errors.append({'row': row, 'id': parent,
+                           'error': 'Could not find %s ID %s' % (proptype, parent)})
+    if bind:
+        g.c.executemany(sql, bind)
+    return len(bind)
+
+
+def neuron_filters(result):
+    ''' Validate the _limit and min_size keys for the /unassigned endpoints
+        and record them in the rest envelope. Neither is applied unless the
+        caller asks for it.
+    '''
+    try:
+        limit = int(request.args['_limit']) if '_limit' in request.args else None
+        min_size = int(request.args['min_size']) if 'min_size' in request.args else None
+    except ValueError:
+        raise InvalidUsage('_limit and min_size must be integers')
+    if limit is not None and limit < 1:
+        raise InvalidUsage('_limit must be positive')
+    if limit is not None:
+        result['rest']['limit'] = limit
+    if min_size is not None:
+        result['rest']['min_size'] = min_size
+    return min_size, limit
+
+
+def neuron_cypher(rois, statuses, min_size=None, limit=None):
+    ''' Return the Cypher query for neurons in any of the given ROIs with
+        one of the given statuses (or, if statuses is None, pending
+        assignment). Only the fields the response needs (and the ROI flags,
+        so results can be split per ROI) are returned. neuPrint's custom
+        endpoint doesn't take parameters, so ROI names are validated and
+        statuses are quoted as Cypher string literals.
+    '''
+    for roi in rois:
+        if not roi or '`' in roi:
+            raise InvalidUsage('Invalid ROI ' + roi)
+    roi_clause = '(' + ' OR '.join(['n.`' + roi + '`=true' for roi in rois]) + ')'
+    if statuses is None:
+        status_clause = "(n.status=\"0.5assign\" or NOT EXISTS(n.status))"
+    else:
+        status_clause = '(' + ' OR '.join(["n.status=" + json.dumps(status)
+                                          for status in statuses]) + ')'
+    size_clause = '' if min_size is None else " AND n.size>=" + str(int(min_size))
+    projection = ', '.join(['.bodyId', '.size', '.status', '.timestamp']
+                           + ['.`' + roi + '`' for roi in rois])
+    cypher = "MATCH (n:`hemibrain-Neuron`) WHERE " + roi_clause + " AND " \
+             + status_clause + size_clause + " RETURN n {" + projection + "}" \
+             + " ORDER BY n.size DESC"
+    if limit is not None:
+        cypher += " LIMIT " + str(int(limit))
+    return cypher
+
+
+def neuron_rows(rois, statuses=None, min_size=None, limit=None):
+    ''' Return neuPrint rows for neurons in any of the given ROIs with one of
+        the given statuses, from NEUPRINT_CACHE if possible. Unlimited results
+        are cached per ROI set and per ROI, so a multi-ROI request can be
+        assembled from earlier single-ROI ones.
+    '''
+    rois = tuple(sorted(set(rois)))
+    if statuses is not None:
+        statuses = tuple(sorted(set(statuses)))
+    return NEUPRINT_CACHE.fetch((rois, statuses, min_size, limit),
+                                lambda: assemble_neuron_rows(rois, statuses, min_size, limit))
+
+
+def assemble_neuron_rows(rois, statuses, min_size=None, limit=None):
+    ''' Fetch the rows for neuron_rows from neuPrint, querying only for ROIs
+        that aren't cached. The query sent is saved in g.cypher.
+    '''
+    if limit is not None:
+        # The largest neurons across several ROIs aren't the largest in each
+        # ROI, so limited results can't be split or merged
+        payload = {"cypher": neuron_cypher(rois, statuses, min_size, limit)}
+        g.cypher = payload['cypher']
+        # These queries are read-only, so they can be retried
+        return call_responder('neuprint', 'custom/custom', payload, idempotent=True)['data']
+    rows = {roi: NEUPRINT_CACHE.get(((roi,), statuses, min_size, None)) for roi in rois}
+    missing = [roi for roi in rois if rows[roi] is None]
+    if missing:
+        payload = {"cypher": neuron_cypher(missing, statuses, min_size)}
+        g.cypher = payload['cypher']
+        response = call_responder('neuprint', 'custom/custom', payload, idempotent=True)
+        # Every neuron has a true property for each ROI it's in, so the
+        # response can be split into per-ROI results
+        for roi in missing:
+            rows[roi] = [row for row in response['data'] if row[0].get(roi) is True]
+            if len(rois) > 1:
+                NEUPRINT_CACHE.put(((roi,), statuses, min_size, None), rows[roi])
+        if len(missing) == len(rois):
+            return response['data']
+    if len(rois) == 1:
+        return rows[rois[0]]
+    seen = set()
+    merged = []
+    for roi in rois:
+        for row in rows[roi]:
+            if row[0]['bodyId'] not in seen:
+                seen.add(row[0]['bodyId'])
+                merged.append(row)
+    merged.sort(key=lambda row: row[0].get('size', 0), reverse=True)
+    return merged
+
+
+def neuron_records(rows):
+    ''' Convert neuPrint rows to response records in a single pass (missing
+        and null properties become empty strings), then sort them once by
+        timestamp. The sort is stable, so neurons with the same timestamp keep
+        neuPrint's size order.
+    '''
+    records = [{"body_id": ndat['bodyId'],
+                "size": ndat['size'],
+                "status": '' if ndat.get('status') is None else ndat['status'],
+                "timestamp": '' if ndat.get('timestamp') is None else ndat['timestamp']}
+               for ndat in (row[0] for row in rows)]
+    records.sort(key=itemgetter('timestamp'))
+    return records
+
+
+def json_default(obj):
+    ''' Serialize values the JSON libraries don't handle themselves. Datetimes
+        keep the format clients already parse.
+    '''
+    if isinstance(obj, datetime):
+        # Same as strftime('%a, %-d %b %Y %H:%M:%S'), but faster and
+        # independent of the locale
+        return '%s, %d %s %d %02d:%02d:%02d' % (WEEKDAYS[obj.weekday()], obj.day,
+                                                MONTHS[obj.month - 1], obj.year,
+                                                obj.hour, obj.minute, obj.second)
+    if isinstance(obj, date):
+        return http_date(obj)
+    if isinstance(obj, Decimal):
+        return str(obj)
+    if isinstance(obj, (bytes, bytearray)):
+        return obj.decode('utf-8', 'replace')
+    if isinstance(obj, (dtime, timedelta, UUID)):
+        return str(obj)
+    try:
+        return list(iter(obj))
+    except TypeError:
+        pass
+    raise TypeError("Object of type %s is not JSON serializable" % (type(obj).__name__,))
+
+
+def serializer():
+    ''' Return the configured JSON serializer: orjson if it's installed (and
+        JSON_SERIALIZER is "auto" or "orjson"), otherwise the standard library
+    '''
+    if app.config['JSON_SERIALIZER'] in ['auto', 'orjson'] and orjson:
+        return 'orjson'
+    return 'json'
+
+
+def dumps(obj):
+    ''' Serialize an object to JSON (as bytes) in a single pass '''
+    started = time()
+    sort_keys = app.config['SORT_JSON_KEYS']
+    try:
+        if serializer() == 'orjson':
+            # orjson is a C extension, so pylint can't see its members
+            # pylint: disable=E1101
+            option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+            if sort_keys:
+                option |= orjson.OPT_SORT_KEYS
+            return orjson.dumps(obj, default=json_default, option=option)
+        return json.dumps(obj, default=json_default, sort_keys=sort_keys,
+                          separators=(',', ':')).encode('utf-8')
+    finally:
+        add_timing('serialization', started)
+
+
+def json_response(payload, status=200):
+    return Response(dumps(payload) + b'\n', status=status, mimetype='application/json')
+
+
+def timing_requested():
+    return request.args.get('_timing', '0') not in ('', '0', 'false')
+
+
+def add_timing_breakdown(result):
+    ''' Add the request's timings to the rest envelope, if they were asked
+        for with ?_timing=1
+    '''
+    if timing_requested() and 'timings' in g:
+        result['rest']['timing'] = {category: round(g.timings.get(category, 0), 6)
+                                    for category in TIMINGS}
+        result['rest']['timing']['statements'] = g.c.statements if g.get('c') else 0
+
+
+def serialize_payload(result):
+    ''' Serialize everything but the rest envelope. Returns the payload and
+        the offset splice_rest inserts the envelope at: its sorted position
+        if SORT_JSON_KEYS is set, otherwise the end.
+    '''
+    body = {key: val for key, val in result.items() if key != 'rest'}
+    payload = dumps(body)
+    if not app.config['SORT_JSON_KEYS'] or all(key < 'rest' for key in body):
+        return payload, len(payload) - 1
+    head = dumps({key: val for key, val in body.items() if key < 'rest'})
+    tail = dumps({key: val for key, val in body.items() if key > 'rest'})
+    if head == b'{}':
+        return tail, 1
+    return head[:-1] + b',' + tail[1:], len(head) - 1
+
+
+def splice_rest(payload, split, rest):
+    ''' Add a rest envelope to a serialized payload (a JSON object without
+        one) at offset split, as returned by serialize_payload
+    '''
+    parts = [payload[1:split].rstrip(b','), b'"rest":' + dumps(rest),
+             payload[split:-1].lstrip(b',')]
+    return b'{' + b','.join(part for part in parts if part) + b'}\n'
+
+
 def generate_response(result):
-    global START_TIME
-    result['rest']['elapsed_time'] = str(timedelta(seconds=(time() - START_TIME)))
-    return jsonify(**result)
+    if isgenerator(result.get('data')):
+        if 'columns' in result:
+            return generate_delimited(result)
+        return generate_stream(result)
+    if 'rows' in result and response_format() in ('arrow', 'parquet'):
+        return generate_arrow(result)
+    if g.get('c'):
+        result['rest']['query_count'] = g.c.statements
+    cached = None
+    if g.get('cache_key') and not result['rest']['error']:
+        cached = app.config['CACHED_ENDPOINTS'][g.cache_key[0]]
+    if not (cached or timing_requested()):
+        result['rest']['elapsed_time'] = str(timedelta(seconds=(time() - g.start_time)))
+        return json_response(result)
+    # Serialize the payload first, so the rest envelope can report how long
+    # that took
+    payload, split = serialize_payload(result)
+    if cached:
+        entry = RESPONSE_CACHE.put(g.cache_key, payload, split, result['rest'],
+                                   cached['ttl'], cached['tables'])
+        return cached_response(result, entry)
+    result['rest']['elapsed_time'] = str(timedelta(seconds=(time() - g.start_time)))
+    add_timing_breakdown(result)
+    return Response(splice_rest(payload, split, result['rest']), mimetype='application/json')
+
+
+def cached_response(result, entry):
+    ''' Build a response from a cached payload and a fresh rest envelope.
+        Conditional GETs whose If-None-Match matches the payload's ETag get a
+        304.
+    '''
+    if request.if_none_match.contains_weak(entry['etag']):
+        with RESPONSE_CACHE.lock:
+            RESPONSE_CACHE.stats['not_modified'] += 1
+        response = Response(status=304)
+    else:
+        result['rest']['elapsed_time'] = str(timedelta(seconds=(time() - g.start_time)))
+        add_timing_breakdown(result)
+        response = Response(splice_rest(entry['payload'], entry['split'], result['rest']),
+                            mimetype='application/json')
+    response.set_etag(entry['etag'])
+    return response
 
 
-def publish(result, message):
+def generate_stream(result):
+    ''' Stream rows as NDJSON. The rest envelope is sent in the X-Rest header,
+        and again (with row count and elapsed time) as the last line.
+    '''
+    def generate():
+        count = size = 0
+        for row in result['data']:
+            count += 1
+            line = dumps(row) + b'\n'
+            size += len(line)
+            yield line
+        result['rest']['row_count'] = count
+        result['rest']['elapsed_time'] = str(timedelta(seconds=(time() - g.start_time)))
+        result['rest']['query_count'] = g.c.statements
+        add_timing_breakdown(result)
+        line = dumps({'rest': result['rest']}) + b'\n'
+        g.response_size = size + len(line)
+        yield line
+    headers = {'X-Rest': json.dumps(result['rest'], default=json_default)}
+    return Response(stream_with_context(generate()), mimetype=NDJSON, headers=headers)
+
+
+def generate_delimited(result):
+    ''' Stream tuple rows as CSV or TSV, with a header line. The rest
+        envelope is sent in the X-Rest header.
+    '''
+    fmt = response_format()
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, delimiter=',' if fmt == 'csv' else '\t',
+                            lineterminator='\n')
+        writer.writerow(result['columns'])
+        size = 0
+        for row in result['data']:
+            writer.writerow(row)
+            if buffer.tell() >= app.config['COMPRESS_FLUSH_BYTES']:
+                chunk = buffer.getvalue().encode('utf-8')
+                buffer.seek(0)
+                buffer.truncate()
+                size += len(chunk)
+                yield chunk
+        chunk = buffer.getvalue().encode('utf-8')
+        g.response_size = size + len(chunk)
+        yield chunk
+    headers = {'X-Rest': json.dumps(result['rest'], default=json_default)}
+    return Response(stream_with_context(generate()), mimetype=EXPORT_MIMETYPES[fmt],
+                    headers=headers)
+
+
+def generate_arrow(result):
+    ''' Return columnar rows as an Arrow IPC stream or a Parquet file. The
+        rest envelope is sent in the X-Rest header.
+    '''
+    import pyarrow
+    fmt = response_format()
+    started = time()
+    columns = list(zip(*result['rows']))
+    table = pyarrow.Table.from_arrays([arrow_array(name, column)
+                                       for name, column in zip(result['columns'], columns)],
+                                      names=result['columns'])
+    sink = pyarrow.BufferOutputStream()
+    if fmt == 'arrow':
+        with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+            writer.write_table(table)
+    else:
+        import pyarrow.parquet
+        pyarrow.parquet.write_table(table, sink)
+    body = sink.getvalue().to_pybytes()
+    add_timing('serialization', started)
+    result['rest']['elapsed_time'] = str(timedelta(seconds=(time() - g.start_time)))
+    result['rest']['query_count'] = g.c.statements
+    headers = {'X-Rest': json.dumps(result['rest'], default=json_default)}
+    return Response(body, mimetype=EXPORT_MIMETYPES[fmt], headers=headers)
+
+
+def arrow_array(name, column):
+    ''' Convert a column to an Arrow array. pymysql returns MySQL zero dates
+        as strings among datetimes, so a column Arrow can't type is retried
+        with zero dates as nulls, then as strings.
+    '''
+    import pyarrow
+    try:
+        return pyarrow.array(column)
+    except pyarrow.ArrowException:
+        pass
+    try:
+        return pyarrow.array([None if isinstance(val, str) and val.startswith('0000-00-00')
+                              else val for val in column])
+    except pyarrow.ArrowException:
+        pass
+    try:
+        return pyarrow.array([None if val is None else str(val) for val in column],
+                             type=pyarrow.string())
+    except pyarrow.ArrowException as err:
+        raise InvalidUsage('Could not convert column %s for export: %s' % (name, err), 500)
+
+
+def compressor(encoding):
+    ''' Return compress, flush and finish functions for a content encoding '''
+    if encoding == 'br':
+        comp = brotli.Compressor(quality=app.config['BROTLI_QUALITY'])
+        return comp.process, comp.flush, comp.finish
+    comp = zlib.compressobj(app.config['COMPRESS_LEVEL'], zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return comp.compress, lambda: comp.flush(zlib.Z_SYNC_FLUSH), comp.flush
+
+
+def compress_response(response):
+    ''' Compress a response with the best encoding the client accepts
+        (Brotli if it's installed, or gzip). Responses smaller than
+        COMPRESS_MIN_SIZE are left alone; streamed responses are compressed
+        as they go, flushed every COMPRESS_FLUSH_BYTES so rows keep flowing.
+    '''
+    if response.status_code != 200 or 'Content-Encoding' in response.headers \
+       or response.mimetype not in app.config['COMPRESS_MIMETYPES'] \
+       or response.direct_passthrough:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(['br', 'gzip'] if brotli else ['gzip'])
+    if not encoding:
+        return response
+    if response.is_streamed:
+        response.response = stream_with_context(compress_stream(response.response, encoding))
+    else:
+        body = response.get_data()
+        if len(body) < app.config['COMPRESS_MIN_SIZE']:
+            return response
+        started = time()
+        compress, _, finish = compressor(encoding)
+        response.set_data(compress(body) + finish())
+        add_timing('compression', started)
+        g.compressed_size = response.content_length
+    response.headers['Content-Encoding'] = encoding
+    # The compressed body isn't byte-identical to the ETag's representation
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+def compress_stream(chunks, encoding):
+    compress, flush, finish = compressor(encoding)
+    pending = size = 0
+    for chunk in chunks:
+        started = time()
+        data = compress(chunk)
+        pending += len(chunk)
+        if pending >= app.config['COMPRESS_FLUSH_BYTES']:
+            data += flush()
+            pending = 0
+        add_timing('compression', started)
+        if data:
+            size += len(data)
+            yield data
+    data = finish()
+    g.compressed_size = size + len(data)
+    yield data
+
+
+def kafka_message(result, message):
     message['uri'] = request.url
     message['client'] = 'mad_responder'
     message['user'] = result['rest']['user']
     message['host'] = os.uname()[1]
     message['status'] = 200
     message['time'] = int(time())
-    future = PRODUCER.send(app.config['KAFKA_TOPIC'], json.dumps(message).encode('utf-8'))
+    return json.dumps(message).encode('utf-8')
+
+
+def publish(result, message):
+    started = time()
+    kafka_send(kafka_message(result, message))
+    add_timing('publish', started)
+
+
+def publish_batch(result, messages):
+    ''' Publish several messages as one producer batch. They're all queued
+        first; if KAFKA_SYNC is set, the producer is then flushed once.
+    '''
+    from kafka.errors import KafkaError
+    started = time()
+    for message in messages:
+        kafka_send(kafka_message(result, message), sync=False)
+    if messages and app.config['KAFKA_SYNC']:
+        try:
+            DEPENDENCIES['kafka'].get().flush(timeout=10)
+        except (InvalidUsage, KafkaError) as err:
+            # Undelivered messages are journaled by their errbacks
+            print("Could not flush Kafka batch: %s" % (err,))
+    add_timing('publish', started)
+
+
+def kafka_send(value, sync=None):
+    ''' Send a message to Kafka. Unless KAFKA_SYNC is set (or sync is given),
+        this doesn't wait for the broker: delivery is reported through
+        callbacks, and messages that can't be delivered are spilled to the
+        journal for replay.
+    '''
+    from kafka.errors import KafkaError
+    kafka_count('sent')
     try:
-        future.get(timeout=10)
-    except KafkaError:
-        print("Failed sending to Kafka!")
+        future = DEPENDENCIES['kafka'].get().send(app.config['KAFKA_TOPIC'], value)
+    except InvalidUsage as err:
+        kafka_failed(value, err.message)
+        return
+    except KafkaError as err:
+        kafka_failed(value, err)
+        return
+    if app.config['KAFKA_SYNC'] if sync is None else sync:
+        try:
+            future.get(timeout=10)
+        except KafkaError as err:
+            kafka_failed(value, err)
+        else:
+            kafka_delivered(None)
+        return
+    future.add_callback(kafka_delivered)
+    future.add_errback(kafka_failed, value)
+
+
+def kafka_count(counter, increment=1):
+    with KAFKA_LOCK:
+        KAFKA_STATS[counter] += increment
+
+
+def kafka_delivered(metadata): # pylint: disable=W0613
+    kafka_count('delivered')
+    if KAFKA_JOURNAL.pending() and KAFKA_JOURNAL.start_replay():
+        threading.Thread(target=kafka_replay, name='kafka-replay', daemon=True).start()
+
+
+def kafka_failed(value, err):
+    kafka_count('failed')
+    print("Failed sending to Kafka: %s" % (err,))
+    if KAFKA_JOURNAL.append(value):
+        kafka_count('spilled')
+    else:
+        kafka_count('dropped')
+
+
+def replay_kafka_journal():
+    ''' Replay the journal if it has messages (spilled by any worker) and the
+        broker is reachable. This is run on a timer, so messages are resent
+        even if this worker doesn't deliver anything itself.
+    '''
+    if not KAFKA_JOURNAL.pending():
+        return
+    if DEPENDENCIES['kafka'].get().bootstrap_connected() and KAFKA_JOURNAL.start_replay():
+        kafka_replay()
+
+
+def kafka_replay():
+    ''' Resend journaled messages now that the broker is reachable '''
+    try:
+        values = KAFKA_JOURNAL.take()
+        kafka_count('replayed', len(values))
+        for value in values:
+            kafka_send(value)
+    except Exception as err: # pragma: no cover
+        print("Could not replay Kafka journal: %s" % (err,))
+    finally:
+        KAFKA_JOURNAL.replaying = False
 
 
 # *****************************************************************************
@@ -396,32 +2462,37 @@ def publish(result, message):
 # *****************************************************************************
 
 
-@app.errorhandler(InvalidUsage)
+@BLUEPRINT.app_errorhandler(InvalidUsage)
 def handle_invalid_usage(error):
-    response = jsonify(error.to_dict())
-    response.status_code = error.status_code
-    return response
+    return json_response(error.to_dict(), error.status_code)
 
 
-@app.route('/')
+@BLUEPRINT.route('/')
 def show_swagger():
     return render_template('swagger_ui.html')
 
 
-@app.route("/spec")
+@BLUEPRINT.route("/spec")
 def spec():
     return get_doc_json()
 
 
-@app.route('/doc')
+@BLUEPRINT.route('/doc')
 def get_doc_json():
-    swag = swagger(app)
-    swag['info']['version'] = __version__
-    swag['info']['title'] = "MAD Responder"
-    return jsonify(swag)
+    spec = get_spec()
+    if request.if_none_match.contains_weak(spec['etag']):
+        response = Response(status=304)
+    elif 'gzip' in request.accept_encodings:
+        response = Response(spec['gzip'], mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(spec['json'], mimetype='application/json')
+    response.set_etag(spec['etag'])
+    response.vary.add('Accept-Encoding')
+    return response
 
 
-@app.route("/stats")
+@BLUEPRINT.route("/stats")
 def stats():
     '''
     Show stats
@@ -457,7 +2528,17 @@ def stats():
                            "endpoint_counts": app.config['ENDPOINTS'],
                            "user_counts": app.config['USERS'],
                            "time_since_last_transaction": tbt,
-                           "database_connection": db_connection}
+                           "database_connection": db_connection,
+                           "database_pool": POOL.status(),
+                           "profile_cache": PROFILE_CACHE.status(),
+                           "response_cache": RESPONSE_CACHE.status(),
+                           "neuprint_cache": NEUPRINT_CACHE.status(),
+                           "latency": METRICS.latency(),
+                           "kafka": dict(KAFKA_STATS, journal=KAFKA_JOURNAL.pending()),
+                           "dependencies": {name: dependency.status() for name, dependency
+                                            in DEPENDENCIES.items()},
+                           "upstream_servers": {server: SESSIONS[server][1].status()
+                                                for server in list(SESSIONS)}}
         if None in result['stats']['endpoint_counts']:
             del result['stats']['endpoint_counts']
     except Exception as err:
@@ -467,7 +2548,63 @@ def stats():
     return generate_response(result)
 
 
-@app.route('/processlist/columns', methods=['GET'])
+@BLUEPRINT.route("/metrics")
+def metrics():
+    '''
+    Show metrics
+    Show request metrics for all workers in Prometheus text format
+    ---
+    tags:
+      - Diagnostics
+    responses:
+      200:
+          description: Metrics
+    '''
+    return Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
+
+
+@BLUEPRINT.route("/ready")
+def ready():
+    '''
+    Show readiness
+    Show whether this worker's dependencies are initialized. Returns 503 if
+    any dependency in READY_REQUIRES isn't.
+    ---
+    tags:
+      - Diagnostics
+    responses:
+      200:
+          description: Ready
+      503:
+          description: Not ready
+    '''
+    result = initialize_result()
+    result['dependencies'] = dict()
+    for name, dependency in DEPENDENCIES.items():
+        if not dependency.ready:
+            dependency.start()
+        result['dependencies'][name] = dependency.status()
+    dbc = None
+    try:
+        dbc = POOL.get(timeout=1)
+        dbc.ping(reconnect=False)
+        result['dependencies']['database'] = {'ready': True, 'error': None}
+    except Exception as err:
+        result['dependencies']['database'] = {'ready': False,
+                                              'error': getattr(err, 'message', None) or str(err)}
+    finally:
+        if dbc:
+            POOL.put(dbc)
+    waiting = [name for name in ['database'] + app.config['READY_REQUIRES']
+               if not result['dependencies'][name]['ready']]
+    if waiting:
+        result['rest']['error'] = 'Waiting for ' + ', '.join(waiting)
+        result['rest']['elapsed_time'] = str(timedelta(seconds=(time() - g.start_time)))
+        return json_response(result, 503)
+    return generate_response(result)
+
+
+@BLUEPRINT.route('/processlist/columns', methods=['GET'])
 def get_processlist_columns():
     '''
     Get columns from the system processlist table
@@ -485,7 +2622,7 @@ def get_processlist_columns():
     return generate_response(result)
 
 
-@app.route('/processlist', methods=['GET'])
+@BLUEPRINT.route('/processlist', methods=['GET'])
 def get_processlist_info():
     '''
     Get processlist information (with filtering)
@@ -513,7 +2650,7 @@ def get_processlist_info():
     return generate_response(result)
 
 
-@app.route('/processlist/host', methods=['GET'])
+@BLUEPRINT.route('/processlist/host', methods=['GET'])
 def get_processlist_host_info(): # pragma: no cover
     '''
     Get processlist information for this host
@@ -544,7 +2681,7 @@ def get_processlist_host_info(): # pragma: no cover
     return generate_response(result)
 
 
-@app.route("/ping")
+@BLUEPRINT.route("/ping")
 def pingdb():
     '''
     Ping the database connection
@@ -569,7 +2706,7 @@ def pingdb():
 # *****************************************************************************
 # * Test endpoints                                                            *
 # *****************************************************************************
-@app.route('/test_sqlerror', methods=['GET'])
+@BLUEPRINT.route('/test_sqlerror', methods=['GET'])
 def testsqlerror():
     result = initialize_result()
     try:
@@ -582,7 +2719,7 @@ def testsqlerror():
         raise InvalidUsage(sql_error(err), 500)
 
 
-@app.route('/test_other_error', methods=['GET'])
+@BLUEPRINT.route('/test_other_error', methods=['GET'])
 def testothererror():
     result = initialize_result()
     try:
@@ -596,7 +2733,7 @@ def testothererror():
 # *****************************************************************************
 # * CV/CV term endpoints                                                      *
 # *****************************************************************************
-@app.route('/cvs/columns', methods=['GET'])
+@BLUEPRINT.route('/cvs/columns', methods=['GET'])
 def get_cv_columns():
     '''
     Get columns from cv table
@@ -614,7 +2751,7 @@ def get_cv_columns():
     return generate_response(result)
 
 
-@app.route('/cv_ids', methods=['GET'])
+@BLUEPRINT.route('/cv_ids', methods=['GET'])
 def get_cv_ids():
     '''
     Get CV IDs (with filtering)
@@ -633,7 +2770,7 @@ def get_cv_ids():
           description: CVs not found
     '''
     result = initialize_result()
-    if execute_sql(result, 'SELECT id FROM cv', 'temp'):
+    if execute_cached(result, 'cv', 'temp', columns='id'):
         result['data'] = []
         for col in result['temp']:
             result['data'].append(col['id'])
@@ -641,7 +2778,7 @@ def get_cv_ids():
     return generate_response(result)
 
 
-@app.route('/cvs/<string:sid>', methods=['GET'])
+@BLUEPRINT.route('/cvs/<string:sid>', methods=['GET'])
 def get_cv_by_id(sid):
     '''
     Get CV information for a given ID
@@ -664,13 +2801,13 @@ def get_cv_by_id(sid):
           description: CV ID not found
     '''
     result = initialize_result()
-    if execute_sql(result, 'SELECT * FROM cv', 'temp', sid):
+    if execute_cached(result, 'cv', 'temp', sid):
         get_cv_data(result, result['temp'])
         del result['temp']
     return generate_response(result)
 
 
-@app.route('/cvs', methods=['GET'])
+@BLUEPRINT.route('/cvs', methods=['GET'])
 def get_cv_info():
     '''
     Get CV information (with filtering)
@@ -691,13 +2828,13 @@ def get_cv_info():
           description: CVs not found
     '''
     result = initialize_result()
-    if execute_sql(result, 'SELECT * FROM cv', 'temp'):
+    if execute_cached(result, 'cv', 'temp'):
         get_cv_data(result, result['temp'])
         del result['temp']
     return generate_response(result)
 
 
-@app.route('/cv', methods=['OPTIONS', 'POST'])
+@BLUEPRINT.route('/cv', methods=['OPTIONS', 'POST'])
 def add_cv(): # pragma: no cover
     '''
     Add CV
@@ -739,7 +2876,7 @@ def add_cv(): # pragma: no cover
     result = initialize_result()
     ipd = dict()
     if request.form:
-        result['rest']['form'] = request.form
+        result['rest']['form'] = request.form.to_dict()
         for i in request.form:
             ipd[i] = request.form[i]
     missing = ''
@@ -765,10 +2902,12 @@ def add_cv(): # pragma: no cover
             g.db.commit()
         except Exception as err:
             raise InvalidUsage(sql_error(err), 500)
+        refresh_cv_cache()
+        RESPONSE_CACHE.invalidate('cv')
     return generate_response(result)
 
 
-@app.route('/cvterms/columns', methods=['GET'])
+@BLUEPRINT.route('/cvterms/columns', methods=['GET'])
 def get_cv_term_columns():
     '''
     Get columns from cv_term_vw table
@@ -786,7 +2925,7 @@ def get_cv_term_columns():
     return generate_response(result)
 
 
-@app.route('/cvterm_ids', methods=['GET'])
+@BLUEPRINT.route('/cvterm_ids', methods=['GET'])
 def get_cv_term_ids():
     '''
     Get CV term IDs (with filtering)
@@ -805,7 +2944,7 @@ def get_cv_term_ids():
           description: CV terms not found
     '''
     result = initialize_result()
-    if execute_sql(result, 'SELECT id FROM cv_term_vw', 'temp'):
+    if execute_cached(result, 'cv_term_vw', 'temp', columns='id'):
         result['data'] = []
         for col in result['temp']:
             result['data'].append(col['id'])
@@ -813,7 +2952,7 @@ def get_cv_term_ids():
     return generate_response(result)
 
 
-@app.route('/cvterms/<string:sid>', methods=['GET'])
+@BLUEPRINT.route('/cvterms/<string:sid>', methods=['GET'])
 def get_cv_term_by_id(sid):
     '''
     Get CV term information for a given ID
@@ -836,13 +2975,13 @@ def get_cv_term_by_id(sid):
           description: CV term ID not found
     '''
     result = initialize_result()
-    if execute_sql(result, 'SELECT * FROM cv_term_vw', 'temp', sid):
+    if execute_cached(result, 'cv_term_vw', 'temp', sid):
         get_cv_term_data(result, result['temp'])
         del result['temp']
     return generate_response(result)
 
 
-@app.route('/cvterms', methods=['GET'])
+@BLUEPRINT.route('/cvterms', methods=['GET'])
 def get_cv_term_info():
     '''
     Get CV term information (with filtering)
@@ -863,13 +3002,13 @@ def get_cv_term_info():
           description: CV terms not found
     '''
     result = initialize_result()
-    if execute_sql(result, 'SELECT * FROM cv_term_vw', 'temp'):
+    if execute_cached(result, 'cv_term_vw', 'temp'):
         get_cv_term_data(result, result['temp'])
         del result['temp']
     return generate_response(result)
 
 
-@app.route('/cvterm', methods=['OPTIONS', 'POST'])
+@BLUEPRINT.route('/cvterm', methods=['OPTIONS', 'POST'])
 def add_cv_term(): # pragma: no cover
     '''
     Add CV term
@@ -916,7 +3055,7 @@ def add_cv_term(): # pragma: no cover
     result = initialize_result()
     ipd = dict()
     if request.form:
-        result['rest']['form'] = request.form
+        result['rest']['form'] = request.form.to_dict()
         for i in request.form:
             ipd[i] = request.form[i]
     missing = ''
@@ -943,12 +3082,14 @@ def add_cv_term(): # pragma: no cover
             g.db.commit()
         except Exception as err:
             raise InvalidUsage(sql_error(err), 500)
+        refresh_cv_cache()
+        RESPONSE_CACHE.invalidate('cv_term')
     return generate_response(result)
 
 # *****************************************************************************
 # * Annotation endpoints                                                      *
 # *****************************************************************************
-@app.route('/annotations/columns', methods=['GET'])
+@BLUEPRINT.route('/annotations/columns', methods=['GET'])
 def get_annotations_columns():
     '''
     Get columns from annotation_vw table
@@ -966,7 +3107,7 @@ def get_annotations_columns():
     return generate_response(result)
 
 
-@app.route('/annotation_ids', methods=['GET'])
+@BLUEPRINT.route('/annotation_ids', methods=['GET'])
 def get_annotation_ids():
     '''
     Get annotation IDs (with filtering)
@@ -993,7 +3134,7 @@ def get_annotation_ids():
     return generate_response(result)
 
 
-@app.route('/annotations/<string:sid>', methods=['GET'])
+@BLUEPRINT.route('/annotations/<string:sid>', methods=['GET'])
 def get_annotations_by_id(sid):
     '''
     Get annotation information for a given ID
@@ -1020,7 +3161,7 @@ def get_annotations_by_id(sid):
     return generate_response(result)
 
 
-@app.route('/annotations', methods=['GET'])
+@BLUEPRINT.route('/annotations', methods=['GET'])
 def get_annotation_info():
     '''
     Get annotation information (with filtering)
@@ -1041,11 +3182,11 @@ def get_annotation_info():
           description: Annotations not found
     '''
     result = initialize_result()
-    execute_sql(result, 'SELECT * FROM annotation_vw', 'data')
+    execute_sql(result, 'SELECT * FROM annotation_vw', 'data', raw=True)
     return generate_response(result)
 
 
-@app.route('/annotationprops/columns', methods=['GET'])
+@BLUEPRINT.route('/annotationprops/columns', methods=['GET'])
 def get_annotationprop_columns():
     '''
     Get columns from annotation_property_vw table
@@ -1063,7 +3204,7 @@ def get_annotationprop_columns():
     return generate_response(result)
 
 
-@app.route('/annotationprop_ids', methods=['GET'])
+@BLUEPRINT.route('/annotationprop_ids', methods=['GET'])
 def get_annotationprop_ids():
     '''
     Get annotation property IDs (with filtering)
@@ -1091,7 +3232,7 @@ def get_annotationprop_ids():
     return generate_response(result)
 
 
-@app.route('/annotationprops/<string:sid>', methods=['GET'])
+@BLUEPRINT.route('/annotationprops/<string:sid>', methods=['GET'])
 def get_annotationprops_by_id(sid):
     '''
     Get annotation property information for a given ID
@@ -1118,7 +3259,7 @@ def get_annotationprops_by_id(sid):
     return generate_response(result)
 
 
-@app.route('/annotationprops', methods=['GET'])
+@BLUEPRINT.route('/annotationprops', methods=['GET'])
 def get_annotationprop_info():
     '''
     Get annotation property information (with filtering)
@@ -1141,14 +3282,18 @@ def get_annotationprop_info():
           description: Annotation properties not found
     '''
     result = initialize_result()
-    execute_sql(result, 'SELECT * FROM annotation_property_vw', 'data')
+    execute_sql(result, 'SELECT * FROM annotation_property_vw', 'data', raw=True)
     return generate_response(result)
 
 
-@app.route('/annotationprop', methods=['OPTIONS', 'POST'])
+@BLUEPRINT.route('/annotationprop', methods=['OPTIONS', 'POST'])
 def update_annotation_property(): # pragma: no cover
     '''
     Add/update an annotation property
+    To add properties in bulk, send a JSON array (or an NDJSON body, with
+    Content-Type application/x-ndjson) of {id, cv, term, value} objects.
+    They're inserted in one transaction; the response has counts of
+    inserted and rejected rows, and an error for each rejected row.
     ---
     tags:
       - Annotation
@@ -1187,7 +3332,7 @@ def update_annotation_property(): # pragma: no cover
 # *****************************************************************************
 # * Assignment endpoints                                                      *
 # *****************************************************************************
-@app.route('/unassigned/<string:roi>', methods=['GET'])
+@BLUEPRINT.route('/unassigned/<string:roi>', methods=['GET'])
 def get_unassigned_roi(roi):
     '''
     Return a list of neurons pending assignment.
@@ -1202,6 +3347,16 @@ def get_unassigned_roi(roi):
         type: string
         required: true
         description: comma-separaed list of neuron ROIs
+      - in: query
+        name: min_size
+        type: integer
+        required: false
+        description: minimum neuron size
+      - in: query
+        name: _limit
+        type: integer
+        required: false
+        description: return only this many of the largest neurons
     responses:
       200:
           description: List of unassigned neurons
@@ -1210,36 +3365,19 @@ def get_unassigned_roi(roi):
     '''
     result = initialize_result()
     roi_list = roi.split(',')
-    roi_clause_list = []
-    status_clause = "(n.status=\"0.5assign\" or NOT EXISTS(n.status))"
-    for this_roi in roi_list:
-        roi_clause_list.append('n.`' + this_roi + '`=true')
-    roi_clause = '(' + ' OR '.join(roi_clause_list) + ')'
-    payload = {"cypher": "MATCH (n:`hemibrain-Neuron`) WHERE " + roi_clause + " AND "
-               + status_clause + " RETURN n ORDER BY n.size DESC"}
-    result['rest']['cypher'] = payload['cypher']
-    response = call_responder('neuprint', 'custom/custom', payload)
-    nlist = []
-    if len(response['data']) == 0:
+    min_size, limit = neuron_filters(result)
+    rows = neuron_rows(roi_list, None, min_size, limit)
+    if g.get('cypher'):
+        # Only the query actually sent upstream; none on a cache hit
+        result['rest']['cypher'] = g.cypher
+    if not rows:
         raise InvalidUsage('No neurons found', 404)
-    result['rest']['row_count'] = len(response['data'])
-    for row in response['data']:
-        ndat = row[0]
-        status = ''
-        if 'status' in ndat:
-            status = ndat['status']
-        timestamp = ''
-        if 'timestamp' in ndat:
-            timestamp = ndat['timestamp']
-        nlist.append({"body_id": ndat['bodyId'],
-                      "size": ndat['size'],
-                      "status": status,
-                      "timestamp": timestamp})
-        result['data'] = sorted(nlist, key = lambda i: i['timestamp']) 
+    result['rest']['row_count'] = len(rows)
+    result['data'] = neuron_records(rows)
     return generate_response(result)
 
 
-@app.route('/unassigned/<string:roi>/<string:status>', methods=['GET'])
+@BLUEPRINT.route('/unassigned/<string:roi>/<string:status>', methods=['GET'])
 def get_unassigned_roi_status(roi, status):
     '''
     Return a list of neurons for a given ROI/status.
@@ -1260,6 +3398,16 @@ def get_unassigned_roi_status(roi, status):
         type: string
         required: true
         description: comma-separaed list of neuron statuses
+      - in: query
+        name: min_size
+        type: integer
+        required: false
+        description: minimum neuron size
+      - in: query
+        name: _limit
+        type: integer
+        required: false
+        description: return only this many of the largest neurons
     responses:
       200:
           description: List of neurons
@@ -1268,38 +3416,20 @@ def get_unassigned_roi_status(roi, status):
     '''
     result = initialize_result()
     roi_list = roi.split(',')
-    roi_clause_list = []
-    for this_roi in roi_list:
-        roi_clause_list.append('n.`' + this_roi + '`=true')
-    roi_clause = '(' + ' OR '.join(roi_clause_list) + ')'
     status_list = status.split(',')
-    status_clause_list = []
-    for this_status in status_list:
-        status_clause_list.append("n.status=\"" + this_status + "\"")
-    status_clause = '(' + ' OR '.join(status_clause_list) + ')'
-    payload = {"cypher": "MATCH (n:`hemibrain-Neuron`) WHERE " + roi_clause + " AND "
-               + status_clause + " RETURN n ORDER BY n.size DESC"}
-    result['rest']['cypher'] = payload['cypher']
-    print(payload['cypher'])
-    response = call_responder('neuprint', 'custom/custom', payload)
-    nlist = []
-    if len(response['data']) == 0:
+    min_size, limit = neuron_filters(result)
+    rows = neuron_rows(roi_list, status_list, min_size, limit)
+    if g.get('cypher'):
+        # Only the query actually sent upstream; none on a cache hit
+        result['rest']['cypher'] = g.cypher
+    if not rows:
         raise InvalidUsage('No neurons found', 404)
-    result['rest']['row_count'] = len(response['data'])
-    for row in response['data']:
-        ndat = row[0]
-        timestamp = ''
-        if 'timestamp' in ndat:
-            timestamp = ndat['timestamp']
-        nlist.append({"body_id": ndat['bodyId'],
-                      "size": ndat['size'],
-                      "status": ndat['status'],
-                      "timestamp": timestamp})
-        result['data'] = sorted(nlist, key = lambda i: i['timestamp']) 
+    result['rest']['row_count'] = len(rows)
+    result['data'] = neuron_records(rows)
     return generate_response(result)
 
 
-@app.route('/assignments/columns', methods=['GET'])
+@BLUEPRINT.route('/assignments/columns', methods=['GET'])
 def get_assignment_columns():
     '''
     Get columns from assignment_vw table
@@ -1317,7 +3447,7 @@ def get_assignment_columns():
     return generate_response(result)
 
 
-@app.route('/assignment_ids', methods=['GET'])
+@BLUEPRINT.route('/assignment_ids', methods=['GET'])
 def get_assignment_ids():
     '''
     Get assignment IDs (with filtering)
@@ -1344,7 +3474,7 @@ def get_assignment_ids():
     return generate_response(result)
 
 
-@app.route('/assignments/<string:sid>', methods=['GET'])
+@BLUEPRINT.route('/assignments/<string:sid>', methods=['GET'])
 def get_assignments_by_id(sid):
     '''
     Get assignment information for a given ID
@@ -1371,7 +3501,7 @@ def get_assignments_by_id(sid):
     return generate_response(result)
 
 
-@app.route('/assignments', methods=['GET'])
+@BLUEPRINT.route('/assignments', methods=['GET'])
 def get_assignment_info():
     '''
     Get assignment information (with filtering)
@@ -1392,11 +3522,11 @@ def get_assignment_info():
           description: Assignments not found
     '''
     result = initialize_result()
-    execute_sql(result, 'SELECT * FROM assignment_vw', 'data')
+    execute_sql(result, 'SELECT * FROM assignment_vw', 'data', raw=True)
     return generate_response(result)
 
 
-@app.route('/assignments_completed', methods=['GET'])
+@BLUEPRINT.route('/assignments_completed', methods=['GET'])
 def get_assignment_completed_info():
     '''
     Get completed assignment information (with filtering)
@@ -1417,11 +3547,11 @@ def get_assignment_completed_info():
           description: Assignments not found
     '''
     result = initialize_result()
-    execute_sql(result, 'SELECT * FROM assignment_vw WHERE is_complete=1', 'data')
+    execute_sql(result, 'SELECT * FROM assignment_vw WHERE is_complete=1', 'data', raw=True)
     return generate_response(result)
 
 
-@app.route('/assignments_open', methods=['GET'])
+@BLUEPRINT.route('/assignments_open', methods=['GET'])
 def get_assignment_open():
     '''
     Get open assignment information (with filtering)
@@ -1443,11 +3573,11 @@ def get_assignment_open():
           description: Assignments not found
     '''
     result = initialize_result()
-    execute_sql(result, "SELECT * FROM assignment_vw WHERE is_complete=0 AND start_date='0000-00-00'", 'data')
+    execute_sql(result, "SELECT * FROM assignment_vw WHERE is_complete=0 AND start_date='0000-00-00'", 'data', raw=True)
     return generate_response(result)
 
 
-@app.route('/assignments_remaining', methods=['GET'])
+@BLUEPRINT.route('/assignments_remaining', methods=['GET'])
 def get_assignment_remaining_info():
     '''
     Get remaining assignment information (with filtering)
@@ -1470,11 +3600,11 @@ def get_assignment_remaining_info():
           description: Assignments not found
     '''
     result = initialize_result()
-    execute_sql(result, 'SELECT * FROM assignment_vw WHERE is_complete=0', 'data')
+    execute_sql(result, 'SELECT * FROM assignment_vw WHERE is_complete=0', 'data', raw=True)
     return generate_response(result)
 
 
-@app.route('/assignments_started', methods=['GET'])
+@BLUEPRINT.route('/assignments_started', methods=['GET'])
 def get_assignment_started():
     '''
     Get started assignment information (with filtering)
@@ -1496,11 +3626,11 @@ def get_assignment_started():
           description: Assignments not found
     '''
     result = initialize_result()
-    execute_sql(result, "SELECT * FROM assignment_vw WHERE is_complete=0 AND start_date>'0000-00-00'", 'data')
+    execute_sql(result, "SELECT * FROM assignment_vw WHERE is_complete=0 AND start_date>'0000-00-00'", 'data', raw=True)
     return generate_response(result)
 
 
-@app.route('/assignmentprops/columns', methods=['GET'])
+@BLUEPRINT.route('/assignmentprops/columns', methods=['GET'])
 def get_assignmentprop_columns():
     '''
     Get columns from assignment_property_vw table
@@ -1518,7 +3648,7 @@ def get_assignmentprop_columns():
     return generate_response(result)
 
 
-@app.route('/assignmentprop_ids', methods=['GET'])
+@BLUEPRINT.route('/assignmentprop_ids', methods=['GET'])
 def get_assignmentprop_ids():
     '''
     Get assignment property IDs (with filtering)
@@ -1546,7 +3676,7 @@ def get_assignmentprop_ids():
     return generate_response(result)
 
 
-@app.route('/assignmentprops/<string:sid>', methods=['GET'])
+@BLUEPRINT.route('/assignmentprops/<string:sid>', methods=['GET'])
 def get_assignmentprops_by_id(sid):
     '''
     Get assignment property information for a given ID
@@ -1573,7 +3703,7 @@ def get_assignmentprops_by_id(sid):
     return generate_response(result)
 
 
-@app.route('/assignmentprops', methods=['GET'])
+@BLUEPRINT.route('/assignmentprops', methods=['GET'])
 def get_assignmentprop_info():
     '''
     Get assignment property information (with filtering)
@@ -1596,11 +3726,11 @@ def get_assignmentprop_info():
           description: Assignment properties not found
     '''
     result = initialize_result()
-    execute_sql(result, 'SELECT * FROM assignment_property_vw', 'data')
+    execute_sql(result, 'SELECT * FROM assignment_property_vw', 'data', raw=True)
     return generate_response(result)
 
 
-@app.route('/start_assignment', methods=['OPTIONS', 'POST'])
+@BLUEPRINT.route('/start_assignment', methods=['OPTIONS', 'POST'])
 def start_assignment(): # pragma: no cover
     '''
     Start an assignment
@@ -1627,7 +3757,7 @@ def start_assignment(): # pragma: no cover
     result = initialize_result()
     ipd = dict()
     if request.form:
-        result['rest']['form'] = request.form
+        result['rest']['form'] = request.form.to_dict()
         for i in request.form:
             ipd[i] = request.form[i]
     if 'id' not in ipd:
@@ -1644,6 +3774,7 @@ def start_assignment(): # pragma: no cover
             g.c.execute(stmt, bind)
             result['rest']['row_count'] = g.c.rowcount
             g.db.commit()
+            RESPONSE_CACHE.invalidate('assignment')
         except Exception as err:
             raise InvalidUsage(sql_error(err), 500)
     if result['rest']['row_count'] == 0:
@@ -1655,7 +3786,7 @@ def start_assignment(): # pragma: no cover
     return generate_response(result)
 
 
-@app.route('/complete_assignment', methods=['OPTIONS', 'POST'])
+@BLUEPRINT.route('/complete_assignment', methods=['OPTIONS', 'POST'])
 def complete_assignment(): # pragma: no cover
     '''
     Complete an assignment
@@ -1682,7 +3813,7 @@ def complete_assignment(): # pragma: no cover
     result = initialize_result()
     ipd = dict()
     if request.form:
-        result['rest']['form'] = request.form
+        result['rest']['form'] = request.form.to_dict()
         for i in request.form:
             ipd[i] = request.form[i]
     if 'id' not in ipd:
@@ -1699,6 +3830,7 @@ def complete_assignment(): # pragma: no cover
             g.c.execute(stmt, bind)
             result['rest']['row_count'] = g.c.rowcount
             g.db.commit()
+            RESPONSE_CACHE.invalidate('assignment')
         except Exception as err:
             raise InvalidUsage(sql_error(err), 500)
     if result['rest']['row_count'] == 0:
@@ -1710,7 +3842,7 @@ def complete_assignment(): # pragma: no cover
     return generate_response(result)
 
 
-@app.route('/reset_assignment', methods=['OPTIONS', 'POST'])
+@BLUEPRINT.route('/reset_assignment', methods=['OPTIONS', 'POST'])
 def reset_assignment(): # pragma: no cover
     '''
     Reset an assignment (remove start and completion times)
@@ -1728,16 +3860,24 @@ def reset_assignment(): # pragma: no cover
         type: string
         required: false
         description: note
+      - in: query
+        name: async
+        type: string
+        required: false
+        description: if set to 1 (in the query string or form), remove
+                     ElasticSearch activity in the background and return
+                     the task ID
     responses:
       200:
           description: Assignment reset
       400:
           description: Assignment not reset
     '''
+    import elasticsearch
     result = initialize_result()
     ipd = dict()
     if request.form:
-        result['rest']['form'] = request.form
+        result['rest']['form'] = request.form.to_dict()
         for i in request.form:
             ipd[i] = request.form[i]
     if 'id' not in ipd:
@@ -1757,24 +3897,26 @@ def reset_assignment(): # pragma: no cover
     if g.c.rowcount == 0:
         raise InvalidUsage("Assignment ID %s was not found" % (ipd['id']), 404)
     # Remove from ElasticSearch
-    es_deletes = 0
     payload = {"query": {"term": {"mad_id": ipd['id']}}}
+    wait = str(request.values.get('async', '')).lower() not in ['1', 'true', 'yes']
+    index = 'mad_activity-*'
     try:
-        index = 'mad_activity-*'
-        searchres = ESEARCH.search(index=index, body=payload)
+        delres = DEPENDENCIES['elasticsearch'].get().delete_by_query(
+            index=index, body=payload, conflicts='proceed', wait_for_completion=wait)
     except elasticsearch.NotFoundError:
         raise InvalidUsage("Index " + index + " does not exist", 404)
+    except InvalidUsage:
+        # ElasticSearch is unavailable (503)
+        raise
     except Exception as esex: # pragma no cover
-        raise InvalidUsage(str(esex))
-    for hit in searchres['hits']['hits']:
-        try:
-            delres = ESEARCH.delete(index=hit['_index'], doc_type='doc', id=hit['_id'])
-            es_deletes += 1
-        except Exception as esex: # pragma no cover
-            raise InvalidUsage(str(esex))
-    result['rest']['elasticsearch_deletes'] = es_deletes
+        raise InvalidUsage(getattr(esex, 'message', None) or str(esex))
+    if wait:
+        result['rest']['elasticsearch_deletes'] = delres['deleted']
+    else:
+        result['rest']['elasticsearch_task'] = delres['task']
     result['rest']['row_count'] = g.c.rowcount
     g.db.commit()
+    RESPONSE_CACHE.invalidate('assignment')
     # Publish to Kafka
     message = {"category": "assignment", "operation": "reset", "mad_id": ipd['id']}
     if 'note' in ipd:
@@ -1783,10 +3925,162 @@ def reset_assignment(): # pragma: no cover
     return generate_response(result)
 
 
+def transition_outcomes(entries):
+    ''' Return an outcome for each /assignment_transitions entry: invalid, or
+        not_found until its ID is found
+    '''
+    outcomes = []
+    for entry in entries:
+        if not isinstance(entry, dict) or entry.get('id') in (None, ''):
+            outcomes.append({'id': None, 'outcome': 'invalid', 'error': 'Missing id'})
+        elif entry.get('operation') not in ASSIGNMENT_TRANSITIONS:
+            outcomes.append({'id': entry['id'], 'operation': entry.get('operation'),
+                             'outcome': 'invalid', 'error': 'Unknown operation'})
+        else:
+            outcomes.append({'id': entry['id'], 'operation': entry['operation'],
+                             'outcome': 'not_found'})
+    return outcomes
+
+
+def transition_batches(entries, outcomes, found):
+    ''' Mark entries whose IDs were found as updated, and return their
+        (statement, bind) pairs. Entries without a note are grouped into one
+        UPDATE ... WHERE id IN (...) per operation; entries with a note are
+        updated row by row. Pending groups are flushed before an ID already
+        in them is updated again, so repeated IDs keep the order given.
+    '''
+    batches = []
+    pending = dict()
+    pending_ids = dict()
+
+    def flush():
+        for operation, ids in pending.items():
+            batches.append(('UPDATE assignment SET %s WHERE id IN (%s)'
+                            % (ASSIGNMENT_TRANSITIONS[operation], ','.join(['%s'] * len(ids))),
+                            tuple(ids)))
+        pending.clear()
+        pending_ids.clear()
+
+    for entry, out in zip(entries, outcomes):
+        if out['outcome'] != 'not_found' or str(out['id']) not in found:
+            continue
+        out['outcome'] = 'updated'
+        key = str(out['id'])
+        if entry.get('note') is not None:
+            if key in pending_ids:
+                flush()
+            batches.append(('UPDATE assignment SET %s,note=%%s WHERE id=%%s'
+                            % (ASSIGNMENT_TRANSITIONS[out['operation']],),
+                            (entry['note'], out['id'])))
+            continue
+        if pending_ids.get(key, out['operation']) != out['operation']:
+            flush()
+        if key not in pending_ids:
+            pending_ids[key] = out['operation']
+            pending.setdefault(out['operation'], []).append(out['id'])
+    flush()
+    return batches
+
+
+@BLUEPRINT.route('/assignment_transitions', methods=['OPTIONS', 'POST'])
+def assignment_transitions(): # pragma: no cover
+    '''
+    Start, complete or reset assignments in bulk
+    The body is a JSON list of {"id": ..., "operation": ..., "note": ...}
+    entries, where operation is start, complete or reset and note is
+    optional. All updates are applied in one transaction, and the outcome
+    (updated, not_found or invalid) is reported for each entry.
+    ---
+    tags:
+      - Assignment
+    parameters:
+      - in: body
+        name: transitions
+        required: true
+        description: list of {id, operation, note} entries
+      - in: query
+        name: async
+        type: string
+        required: false
+        description: if set to 1 (in the query string or form), remove
+                     ElasticSearch activity for reset assignments in the
+                     background and return the task ID
+    responses:
+      200:
+          description: Per-entry outcomes
+      400:
+          description: Invalid request body
+    '''
+    import elasticsearch
+    result = initialize_result()
+    entries = request.get_json(silent=True)
+    if not isinstance(entries, list) or not entries:
+        raise InvalidUsage('Request body must be a JSON list of {id, operation, note} entries')
+    if len(entries) > app.config['BULK_MAX_ENTRIES']:
+        raise InvalidUsage('No more than %d entries may be sent at once'
+                           % (app.config['BULK_MAX_ENTRIES'],))
+    outcomes = transition_outcomes(entries)
+    ids = sorted({str(out['id']) for out in outcomes if out['outcome'] == 'not_found'})
+    try:
+        found = set()
+        if ids:
+            g.c.execute('SELECT id FROM assignment WHERE id IN (%s)'
+                        % (','.join(['%s'] * len(ids)),), ids)
+            found = {str(row['id']) for row in g.c.fetchall()}
+        for stmt, bind in transition_batches(entries, outcomes, found):
+            g.c.execute(stmt, bind)
+    except Exception as err:
+        g.db.rollback()
+        raise InvalidUsage(sql_error(err), 500)
+    updated = [(entry, out) for entry, out in zip(entries, outcomes)
+               if out['outcome'] == 'updated']
+    reset = sorted({str(out['id']) for _, out in updated if out['operation'] == 'reset'})
+    if reset:
+        # Remove activity for every reset assignment with one query
+        payload = {"query": {"terms": {"mad_id": reset}}}
+        wait = str(request.values.get('async', '')).lower() not in ['1', 'true', 'yes']
+        index = 'mad_activity-*'
+        try:
+            delres = DEPENDENCIES['elasticsearch'].get().delete_by_query(
+                index=index, body=payload, conflicts='proceed', wait_for_completion=wait)
+        except elasticsearch.NotFoundError:
+            g.db.rollback()
+            raise InvalidUsage("Index " + index + " does not exist", 404)
+        except InvalidUsage:
+            # ElasticSearch is unavailable (503)
+            g.db.rollback()
+            raise
+        except Exception as esex: # pragma no cover
+            g.db.rollback()
+            raise InvalidUsage(getattr(esex, 'message', None) or str(esex))
+        if wait:
+            result['rest']['elasticsearch_deletes'] = delres['deleted']
+        else:
+            result['rest']['elasticsearch_task'] = delres['task']
+    try:
+        g.db.commit()
+    except Exception as err:
+        raise InvalidUsage(sql_error(err), 500)
+    if updated:
+        RESPONSE_CACHE.invalidate('assignment')
+    result['rest']['row_count'] = len(updated)
+    result['data'] = outcomes
+    messages = []
+    for entry, out in updated:
+        # The single-ID endpoints publish the ID as a string
+        message = {"category": "assignment", "operation": out['operation'],
+                   "mad_id": str(out['id'])}
+        if entry.get('note') is not None:
+            message['note'] = entry['note']
+        messages.append(message)
+    publish_batch(result, messages)
+    return generate_response(result)
+
+
 # *****************************************************************************
 # * Media endpoints                                                           *
 # *****************************************************************************
-@app.route('/media/columns', methods=['GET'])
+@BLUEPRINT.route('/media/columns', methods=['GET'])
 def get_media_columns():
     '''
     Get columns from media_vw table
@@ -1804,7 +4098,7 @@ def get_media_columns():
     return generate_response(result)
 
 
-@app.route('/media_ids', methods=['GET'])
+@BLUEPRINT.route('/media_ids', methods=['GET'])
 def get_media_ids():
     '''
     Get media IDs (with filtering)
@@ -1831,7 +4125,7 @@ def get_media_ids():
     return generate_response(result)
 
 
-@app.route('/media/<string:sid>', methods=['GET'])
+@BLUEPRINT.route('/media/<string:sid>', methods=['GET'])
 def get_media_by_id(sid):
     '''
     Get media information for a given ID
@@ -1858,7 +4152,7 @@ def get_media_by_id(sid):
     return generate_response(result)
 
 
-@app.route('/media', methods=['GET'])
+@BLUEPRINT.route('/media', methods=['GET'])
 def get_media_info():
     '''
     Get media information (with filtering)
@@ -1879,11 +4173,11 @@ def get_media_info():
           description: Media not found
     '''
     result = initialize_result()
-    execute_sql(result, 'SELECT * FROM media_vw', 'data')
+    execute_sql(result, 'SELECT * FROM media_vw', 'data', raw=True)
     return generate_response(result)
 
 
-@app.route('/mediaprops/columns', methods=['GET'])
+@BLUEPRINT.route('/mediaprops/columns', methods=['GET'])
 def get_mediaprop_columns():
     '''
     Get columns from media_property_vw table
@@ -1901,7 +4195,7 @@ def get_mediaprop_columns():
     return generate_response(result)
 
 
-@app.route('/mediaprop_ids', methods=['GET'])
+@BLUEPRINT.route('/mediaprop_ids', methods=['GET'])
 def get_mediaprop_ids():
     '''
     Get media property IDs (with filtering)
@@ -1929,7 +4223,7 @@ def get_mediaprop_ids():
     return generate_response(result)
 
 
-@app.route('/mediaprops/<string:sid>', methods=['GET'])
+@BLUEPRINT.route('/mediaprops/<string:sid>', methods=['GET'])
 def get_mediaprops_by_id(sid):
     '''
     Get media property information for a given ID
@@ -1956,7 +4250,7 @@ def get_mediaprops_by_id(sid):
     return generate_response(result)
 
 
-@app.route('/mediaprops', methods=['GET'])
+@BLUEPRINT.route('/mediaprops', methods=['GET'])
 def get_mediaprop_info():
     '''
     Get media property information (with filtering)
@@ -1979,14 +4273,14 @@ def get_mediaprop_info():
           description: Media properties not found
     '''
     result = initialize_result()
-    execute_sql(result, 'SELECT * FROM media_property_vw', 'data')
+    execute_sql(result, 'SELECT * FROM media_property_vw', 'data', raw=True)
     return generate_response(result)
 
 
 # *****************************************************************************
 # * DVID endpoints                                                            *
 # *****************************************************************************
-@app.route('/dvid_instances', methods=['GET'])
+@BLUEPRINT.route('/dvid_instances', methods=['GET'])
 def get_dvid_info():
     '''
     Get DVID url/UUID information (with filtering)
@@ -2008,14 +4302,14 @@ def get_dvid_info():
           description: DVID instances not found
     '''
     result = initialize_result()
-    execute_sql(result, 'SELECT * FROM dvid_url_uuid_vw', 'data')
+    execute_sql(result, 'SELECT * FROM dvid_url_uuid_vw', 'data', raw=True)
     return generate_response(result)
 
 
 # *****************************************************************************
 # * User endpoints                                                            *
 # *****************************************************************************
-@app.route('/users', methods=['GET'])
+@BLUEPRINT.route('/users', methods=['GET'])
 def get_user_info():
     '''
     Get user information (with filtering)
@@ -2037,12 +4331,18 @@ def get_user_info():
           description: Users not found
     '''
     result = initialize_result()
-    execute_sql(result, 'SELECT * FROM user_property_vw', 'data')
+    execute_sql(result, 'SELECT * FROM user_property_vw', 'data', raw=True)
     return generate_response(result)
 
 
 # *****************************************************************************
 
 
+app = create_app()
+
 if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == '--write-spec':
+        write_spec(sys.argv[2])
+        sys.exit(0)
+    warmup()
     app.run(debug=True)
@@ -1,5 +1,21 @@
-from mad_responder import app
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import gzip
+from importlib.util import find_spec
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from time import sleep, time
 import unittest
+from unittest.mock import Mock, patch
+from benchmarks import HERE, HEAVY_MODULES, IMPORT_CHECK
+from flask import g, request
+import mad_responder
+from mad_responder import app, warmup, arrow_array, CircuitBreaker, InvalidUsage, KafkaJournal, UpstreamCache, insert_properties, \
+                          ndjson_entries, neuron_cypher, neuron_filters, transition_batches, \
+                          replay_kafka_journal, serialize_payload, splice_rest, transition_outcomes
 
 ANNOTATION_ID = 352848
 ANNOTATIONPROP_ID = 20713727
@@ -28,12 +44,30 @@ class TestDiagnostics(unittest.TestCase):
     def test_doc(self):
         response = self.app.get('/doc')
         self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        response = self.app.get('/doc', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        response = self.app.get('/doc', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
 
     def test_stats(self):
         response = self.app.get('/stats')
         self.assertEqual(response.status_code, 200)
         self.assertGreater(response.json['stats']['requests'], 0)
 
+    def test_metrics(self):
+        self.app.get('/ping')
+        response = self.app.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'mad_request_duration_seconds_bucket{endpoint="pingdb"',
+                      response.data)
+
+    def test_ready(self):
+        warmup()
+        response = self.app.get('/ready')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json['dependencies']['database']['ready'])
+
     def test_processlist_columns(self):
         response = self.app.get('/processlist/columns')
         self.assertEqual(response.status_code, 200)
@@ -44,6 +78,346 @@ class TestDiagnostics(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json['rest']['error'], False)
 
+class TestStartup(unittest.TestCase):
+    def test_import_is_light(self):
+        # Heavy clients are imported when they're first used, not at import
+        command = [sys.executable, '-c', IMPORT_CHECK % (HEAVY_MODULES,)]
+        output = subprocess.run(command, check=True, stdout=subprocess.PIPE,
+                                cwd=HERE, universal_newlines=True).stdout
+        self.assertEqual(output.strip(), '')
+
+    def test_create_app(self):
+        # In a fresh interpreter, with settings overridden from a file
+        with tempfile.NamedTemporaryFile('w', suffix='.cfg') as settings:
+            settings.write('PAGE_SIZE_DEFAULT = 5\n')
+            settings.flush()
+            code = "import mad_responder\n" \
+                   "print(mad_responder.app.config['PAGE_SIZE_DEFAULT'])\n" \
+                   "try:\n    mad_responder.create_app()\n" \
+                   "except RuntimeError:\n    print('once')"
+            output = subprocess.run([sys.executable, '-c', code], check=True,
+                                    stdout=subprocess.PIPE, cwd=HERE, universal_newlines=True,
+                                    env=dict(os.environ,
+                                             MAD_RESPONDER_SETTINGS=settings.name)).stdout
+        self.assertEqual(output.split(), ['5', 'once'])
+
+class TestUpstreamCache(unittest.TestCase):
+    def test_single_flight(self):
+        cache = UpstreamCache(60, 10)
+        calls = []
+        def loader():
+            calls.append(1)
+            sleep(0.2)
+            return ['row']
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            values = list(executor.map(lambda _: cache.fetch('key', loader), range(8)))
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(values, [['row']] * 8)
+        self.assertEqual(cache.fetch('key', loader), ['row'])
+        self.assertEqual(len(calls), 1)
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_trip_and_close(self):
+        breaker = CircuitBreaker(2, 0.1)
+        breaker.failure()
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertFalse(breaker.allow())
+        self.assertTrue(breaker.status()['open'])
+        self.assertEqual(breaker.status()['trips'], 1)
+        sleep(0.15)
+        # Half-open: one test request is let through, and its success closes
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.allow())
+        breaker.success()
+        self.assertTrue(breaker.allow())
+        self.assertTrue(breaker.allow())
+        self.assertFalse(breaker.status()['open'])
+
+    def test_test_request_fails(self):
+        breaker = CircuitBreaker(1, 0.1)
+        breaker.failure()
+        sleep(0.15)
+        self.assertTrue(breaker.allow())
+        breaker.failure()
+        self.assertFalse(breaker.allow())
+        self.assertEqual(breaker.status()['trips'], 2)
+
+    def test_single_test_request(self):
+        breaker = CircuitBreaker(1, 0.1)
+        breaker.failure()
+        sleep(0.15)
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            allowed = list(executor.map(lambda _: breaker.allow(), range(8)))
+        self.assertEqual(allowed.count(True), 1)
+
+class TestSpliceRest(unittest.TestCase):
+    def test_sorted_position(self):
+        # The rest envelope goes where json.dumps(sort_keys=True) would put it
+        for result in ({'data': [1], 'rest': {'row_count': 1}},
+                       {'data': [1], 'rest': {'a': 1}, 'total_rows': 9, 'version': 'v'},
+                       {'rest': {}, 'total_rows': 9},
+                       {'rest': {'a': None}}):
+            with patch.dict(app.config, {'SORT_JSON_KEYS': True}):
+                payload, split = serialize_payload(result)
+                spliced = splice_rest(payload, split, result['rest'])
+            self.assertEqual(spliced.decode('utf-8'),
+                             json.dumps(result, sort_keys=True, separators=(',', ':')) + '\n')
+
+class StubProducer():
+    def __init__(self):
+        self.sent = []
+
+    def get(self):
+        return self
+
+    @staticmethod
+    def bootstrap_connected():
+        return True
+
+    def send(self, topic, value):
+        self.sent.append(value)
+        return Mock()
+
+
+@unittest.skipUnless(find_spec('pyarrow'), 'pyarrow is not installed')
+class TestArrowExport(unittest.TestCase):
+    def test_zero_dates(self):
+        import pyarrow
+        column = (datetime(2019, 1, 2), '0000-00-00 00:00:00', None)
+        array = arrow_array('start_date', column)
+        self.assertEqual(array.type, pyarrow.timestamp('us'))
+        self.assertEqual(array.null_count, 2)
+
+    def test_mixed_types(self):
+        array = arrow_array('value', (1, 'two', None))
+        self.assertEqual(array.to_pylist(), ['1', 'two', None])
+
+class TestKafkaJournal(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'journal')
+
+    def test_spill(self):
+        journal = KafkaJournal(self.path, 3)
+        for idx in range(4):
+            self.assertEqual(journal.append(b'message %d' % (idx,)), idx < 3)
+        self.assertEqual(journal.pending(), 3)
+        self.assertEqual(journal.take(), [b'message 0', b'message 1', b'message 2'])
+        self.assertEqual(journal.pending(), 0)
+
+    def test_shared_between_workers(self):
+        # Each worker has its own KafkaJournal on the same file
+        first, second = KafkaJournal(self.path, 3), KafkaJournal(self.path, 3)
+        self.assertEqual(first.pending(), 0)
+        second.append(b'a')
+        second.append(b'b')
+        self.assertEqual(first.pending(), 2)
+        first.append(b'c')
+        self.assertFalse(second.append(b'd'))
+
+    def test_replay(self):
+        journal = KafkaJournal(self.path, 10)
+        journal.append(b'{"operation": "start"}')
+        producer = StubProducer()
+        with patch.object(mad_responder, 'KAFKA_JOURNAL', journal), \
+             patch.dict(mad_responder.DEPENDENCIES, {'kafka': producer}):
+            replay_kafka_journal()
+        self.assertEqual(producer.sent, [b'{"operation": "start"}'])
+        self.assertEqual(journal.pending(), 0)
+        self.assertFalse(journal.replaying)
+
+class TestNeuronCypher(unittest.TestCase):
+    def test_status_quoting(self):
+        cypher = neuron_cypher(['roi'], ['a"b', 'c\\d'])
+        self.assertIn('(n.status="a\\"b" OR n.status="c\\\\d")', cypher)
+
+    def test_roi_backtick(self):
+        with self.assertRaises(InvalidUsage) as err:
+            neuron_cypher(['roi`) OR true //'], None)
+        self.assertEqual(err.exception.status_code, 400)
+
+    def test_projection(self):
+        cypher = neuron_cypher(['a', 'b'], None)
+        self.assertIn('RETURN n {.bodyId, .size, .status, .timestamp, .`a`, .`b`}', cypher)
+        self.assertNotIn('LIMIT', cypher)
+
+    def test_integer_filters(self):
+        cypher = neuron_cypher(['roi'], None, 5.7, '10')
+        self.assertIn(' AND n.size>=5 RETURN', cypher)
+        self.assertTrue(cypher.endswith(' ORDER BY n.size DESC LIMIT 10'))
+        with app.test_request_context('/unassigned/roi?min_size=1%20OR%20true'):
+            with self.assertRaises(InvalidUsage):
+                neuron_filters({'rest': {}})
+        with app.test_request_context('/unassigned/roi?_limit=0'):
+            with self.assertRaises(InvalidUsage):
+                neuron_filters({'rest': {}})
+        with app.test_request_context('/unassigned/roi?min_size=100&_limit=20'):
+            result = {'rest': {}}
+            self.assertEqual(neuron_filters(result), (100, 20))
+            self.assertEqual(result['rest'], {'min_size': 100, 'limit': 20})
+
+    def test_cypher_sent(self):
+        # Only uncached ROIs are queried, and a cache hit sends nothing
+        rows = {'data': [[{'bodyId': 1, 'size': 9, 'a': True}],
+                         [{'bodyId': 2, 'size': 5, 'b': True}]]}
+        with patch.object(mad_responder, 'NEUPRINT_CACHE', UpstreamCache(60, 10)), \
+             patch.object(mad_responder, 'call_responder', return_value=rows) as responder:
+            with app.test_request_context('/unassigned/a'):
+                mad_responder.neuron_rows(['a'])
+                self.assertEqual(g.cypher, neuron_cypher(['a'], None))
+            with app.test_request_context('/unassigned/a,b'):
+                self.assertEqual([row[0]['bodyId'] for row in mad_responder.neuron_rows(['a', 'b'])],
+                                 [1, 2])
+                self.assertEqual(g.cypher, neuron_cypher(['b'], None))
+            with app.test_request_context('/unassigned/a,b'):
+                mad_responder.neuron_rows(['b', 'a'])
+                self.assertNotIn('cypher', g)
+        self.assertEqual(responder.call_count, 2)
+
+class TestAssignmentTransitions(unittest.TestCase):
+    ENTRIES = [{'id': 1, 'operation': 'start'},
+               {'id': '2', 'operation': 'start'},
+               {'id': 1, 'operation': 'complete', 'note': 'done'},
+               {'id': 1, 'operation': 'start'},
+               {'id': 99, 'operation': 'reset'},
+               {'id': 3, 'operation': 'archive'},
+               {'operation': 'start'}]
+
+    def test_outcomes(self):
+        outcomes = transition_outcomes(self.ENTRIES)
+        transition_batches(self.ENTRIES, outcomes, {'1', '2'})
+        self.assertEqual([out['outcome'] for out in outcomes],
+                         ['updated', 'updated', 'updated', 'updated', 'not_found',
+                          'invalid', 'invalid'])
+        self.assertEqual(outcomes[5]['error'], 'Unknown operation')
+        self.assertEqual(outcomes[6]['error'], 'Missing id')
+
+    def test_batches(self):
+        # Entries without a note share one IN statement per operation; a
+        # repeated ID flushes them first, so it keeps its order
+        outcomes = transition_outcomes(self.ENTRIES)
+        batches = transition_batches(self.ENTRIES, outcomes, {'1', '2'})
+        self.assertEqual(batches,
+                         [('UPDATE assignment SET start_date=NOW() WHERE id IN (%s,%s)', (1, '2')),
+                          ('UPDATE assignment SET complete_date=NOW(),note=%s WHERE id=%s',
+                           ('done', 1)),
+                          ('UPDATE assignment SET start_date=NOW() WHERE id IN (%s)', (1,))])
+
+    def test_grouped_operations(self):
+        entries = [{'id': 1, 'operation': 'start'},
+                   {'id': 2, 'operation': 'reset'},
+                   {'id': 3, 'operation': 'start', 'note': 'first'},
+                   {'id': 4, 'operation': 'start'},
+                   {'id': 2, 'operation': 'reset'},
+                   {'id': 5, 'operation': 'reset'}]
+        outcomes = transition_outcomes(entries)
+        batches = transition_batches(entries, outcomes, {'1', '2', '3', '4', '5'})
+        self.assertEqual(batches,
+                         [('UPDATE assignment SET start_date=NOW(),note=%s WHERE id=%s',
+                           ('first', 3)),
+                          ('UPDATE assignment SET start_date=NOW() WHERE id IN (%s,%s)', (1, 4)),
+                          ('UPDATE assignment SET start_date=0,complete_date=0,is_complete=0 '
+                           + 'WHERE id IN (%s,%s)', (2, 5))])
+
+class RecordingCursor():
+    ''' Stands in for the request cursor: parent IDs in PARENTS exist, and
+        executemany calls are recorded
+    '''
+    PARENTS = {'1', '2', '3'}
+
+    def __init__(self):
+        self.rows = []
+        self.selects = []
+        self.inserts = []
+
+    TERMS = {('annotation_property', 'new_term'): 8}
+
+    def execute(self, sql, bind):
+        if 'cv_term_vw' in sql:
+            self.rows = [{'id': self.TERMS[bind]}] if bind in self.TERMS else []
+            return
+        self.selects.append(list(bind))
+        self.rows = [{'id': int(pid)} for pid in bind if pid in self.PARENTS]
+
+    def fetchall(self):
+        return self.rows
+
+    def fetchone(self):
+        return self.rows[0] if self.rows else None
+
+    def executemany(self, sql, bind):
+        self.inserts.append(list(bind))
+
+
+class StubCVCache():
+    ''' A CV cache that has only blocks_annotated '''
+    def __init__(self):
+        self.refreshes = 0
+
+    def get(self):
+        return self
+
+    @staticmethod
+    def term_id(cv, term):
+        return {('annotation_property', 'blocks_annotated'): 7}.get((cv, term))
+
+    def refresh_soon(self):
+        self.refreshes += 1
+
+
+class TestBulkProperties(unittest.TestCase):
+    def insert(self, entries, cv_cache=None):
+        result = {'rest': {}}
+        with app.test_request_context(), \
+             patch.dict(app.config, {'PROPERTY_CHUNK_SIZE': 2}), \
+             patch.dict(mad_responder.DEPENDENCIES, {'cv_cache': cv_cache or StubCVCache()}):
+            # Popped again, so teardown doesn't return them to the pool
+            g.c, g.db = RecordingCursor(), Mock()
+            try:
+                insert_properties(result, 'annotation', entries)
+                g.db.commit.assert_called_once()
+                return result, g.c
+            finally:
+                g.pop('c')
+                g.pop('db')
+
+    def test_term_not_cached(self):
+        # Terms missing from the cache (e.g. added by another worker) are
+        # looked up with SQL, once per batch
+        cv_cache = StubCVCache()
+        row = {'cv': 'annotation_property', 'term': 'new_term', 'value': 'v'}
+        result, cursor = self.insert([dict(row, id=1), dict(row, id=2)], cv_cache)
+        self.assertEqual(result['rest']['inserted'], 2)
+        self.assertEqual(cursor.inserts, [[(1, 8, 'v'), (2, 8, 'v')]])
+        self.assertEqual(cv_cache.refreshes, 1)
+
+    def test_ndjson_entries(self):
+        lines = [b'{"id": 1}\n', b'\n', b'{bad\n', b'[2]\n']
+        entries = list(ndjson_entries(lines))
+        self.assertEqual(entries[0], {'id': 1})
+        self.assertIsInstance(entries[1], InvalidUsage)
+        self.assertEqual(entries[2], [2])
+
+    def test_chunks_and_errors(self):
+        row = {'cv': 'annotation_property', 'term': 'blocks_annotated', 'value': 'v'}
+        entries = [dict(row, id=1), dict(row, id=99), dict(row, id=2),
+                   dict(row, id=3, term='no_such_term'), {'id': 3, 'cv': 'x'},
+                   InvalidUsage('Invalid JSON'), 5, dict(row, id=3)]
+        result, cursor = self.insert(entries)
+        self.assertEqual(result['rest']['inserted'], 3)
+        self.assertEqual(result['rest']['rejected'], 5)
+        # Parents are checked and rows inserted PROPERTY_CHUNK_SIZE at a time
+        self.assertEqual(cursor.selects, [['1', '99'], ['2', '3']])
+        self.assertEqual(cursor.inserts, [[(1, 7, 'v')], [(2, 7, 'v'), (3, 7, 'v')]])
+        self.assertEqual([(err['row'], err['error']) for err in result['data']],
+                         [(1, 'Could not find annotation ID 99'),
+                          (3, 'Could not find CV/term annotation_property/no_such_term'),
+                          (4, 'Missing arguments: term value'),
+                          (5, 'Invalid JSON'),
+                          (6, 'Entry must be an object')])
+
 class TestProcesses(unittest.TestCase):
     def setUp(self):
         self.app = app.test_client()
@@ -82,9 +456,20 @@ class TestContent(unittest.TestCase):
         response = self.app.get('/cv_ids?name=body_type')
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json['data'][0], 70)
+        self.assertTrue(response.json['rest']['cached'])
         response = self.app.get('/cv_ids?name=aint_no_such_cv')
         self.assertEqual(response.status_code, 404)
 
+    def test_cv_etag(self):
+        response = self.app.get('/cvs?name=body_type')
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers['ETag']
+        response = self.app.get('/cvs?name=body_type')
+        self.assertEqual(response.headers['ETag'], etag)
+        self.assertTrue(response.json['rest']['response_cached'])
+        response = self.app.get('/cvs?name=body_type', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+
     def test_cvs(self):
         response = self.app.get('/cvs?id=70')
         self.assertEqual(response.status_code, 200)
@@ -121,6 +506,10 @@ class TestContent(unittest.TestCase):
         response = self.app.get('/cvterms?id=1824')
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response.json['data'][0]['cv_term'], 'substack')
+        response = self.app.get('/cvterms?cv=body_type')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('relationships', response.json['data'][0])
+        self.assertLessEqual(response.json['rest']['query_count'], 3)
         response = self.app.get('/cvterms?id=0')
         self.assertEqual(response.status_code, 404)
 
@@ -191,6 +580,12 @@ class TestContent(unittest.TestCase):
         response = self.app.get('/annotationprops/0')
         self.assertEqual(response.status_code, 404)
 
+    def test_annotationprop_bulk_auth(self):
+        response = self.app.post('/annotationprop',
+                                 json=[{'id': 0, 'cv': 'annotation_property',
+                                        'term': 'blocks_annotated', 'value': 1}])
+        self.assertEqual(response.status_code, 401)
+
 # ******************************************************************************
 # * Assignment endpoints                                                       *
 # ******************************************************************************
@@ -208,6 +603,73 @@ class TestContent(unittest.TestCase):
         response = self.app.get('/assignments?user=no_such_user')
         self.assertEqual(response.status_code, 404)
 
+    def test_assignments_paging(self):
+        response = self.app.get('/assignments?user=shinomiyaa&_limit=10')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json['data']), 10)
+        self.assertEqual(response.json['rest']['next_offset'], 10)
+        response = self.app.get('/assignment_ids?user=shinomiyaa&_after=0&_limit=10')
+        self.assertEqual(response.status_code, 200)
+        last = response.json['data'][-1]
+        self.assertEqual(response.json['rest']['next'], last)
+        response = self.app.get('/assignment_ids?user=shinomiyaa&_limit=10&_after=' + str(last))
+        self.assertEqual(response.status_code, 200)
+        self.assertGreater(response.json['data'][0], last)
+        response = self.app.get('/assignments?_limit=none')
+        self.assertEqual(response.status_code, 400)
+
+    def test_assignments_stream(self):
+        response = self.app.get('/assignments?user=shinomiyaa&_stream=1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertGreaterEqual(len(lines) - 1, 2955)
+        self.assertEqual(json.loads(lines[-1])['rest']['row_count'], len(lines) - 1)
+
+    def test_assignments_gzip(self):
+        response = self.app.get('/assignments?user=shinomiyaa',
+                                headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        payload = json.loads(gzip.decompress(response.data))
+        self.assertGreaterEqual(len(payload['data']), 2955)
+
+    def test_assignments_columnar(self):
+        response = self.app.get('/assignments?user=shinomiyaa&_format=columnar')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('user', response.json['columns'])
+        self.assertEqual(len(response.json['rows']), response.json['rest']['row_count'])
+        response = self.app.get('/assignments?user=shinomiyaa&_format=columns')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['data']['user'][0], 'shinomiyaa')
+
+    def test_assignments_csv(self):
+        response = self.app.get('/assignments?user=shinomiyaa&_format=csv')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/csv')
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertIn('user', lines[0].split(','))
+        self.assertGreaterEqual(len(lines) - 1, 2955)
+        response = self.app.get('/assignments?user=shinomiyaa',
+                                headers={'Accept': 'text/tab-separated-values'})
+        self.assertEqual(response.mimetype, 'text/tab-separated-values')
+
+    @unittest.skipUnless(find_spec('pyarrow'), 'pyarrow is not installed')
+    def test_assignments_arrow(self):
+        import pyarrow
+        response = self.app.get('/assignments?user=shinomiyaa&_format=arrow')
+        self.assertEqual(response.status_code, 200)
+        table = pyarrow.ipc.open_stream(response.data).read_all()
+        self.assertEqual(table.num_rows, json.loads(response.headers['X-Rest'])['row_count'])
+
+    def test_assignments_timing(self):
+        response = self.app.get('/assignments?user=shinomiyaa&_limit=10&_timing=1')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json['rest']['timing']['statements'], 1)
+        self.assertGreater(response.json['rest']['timing']['execute'], 0)
+        response = self.app.get('/assignments?user=shinomiyaa&_limit=10')
+        self.assertNotIn('timing', response.json['rest'])
+
     def test_assignment_columns(self):
         response = self.app.get('/assignments/columns')
         self.assertEqual(response.status_code, 200)
@@ -268,6 +730,11 @@ class TestContent(unittest.TestCase):
         response = self.app.get('/assignmentprops/0')
         self.assertEqual(response.status_code, 404)
 
+    def test_assignment_transitions_auth(self):
+        response = self.app.post('/assignment_transitions',
+                                 json=[{'id': 0, 'operation': 'start'}])
+        self.assertEqual(response.status_code, 401)
+
 # ******************************************************************************
 # * DVID endpoints                                                             *
 # ******************************************************************************
@@ -333,6 +800,60 @@ class TestContent(unittest.TestCase):
         response = self.app.get('/mediaprops/0')
         self.assertEqual(response.status_code, 404)
 
+class TestConcurrency(unittest.TestCase):
+    ''' Fire interleaved SQL-backed /cvterms requests from many threads, with
+        and without _columns=id (which turns off relationships, through
+        g.idcolumn), and every fourth one deliberately slow. Each response
+        must reflect its own request, and report its own elapsed time.
+    '''
+    DELAY = 0.2
+    GENERATE_SQL = mad_responder.generate_sql
+
+    def setUp(self):
+        for patcher in (patch.dict(app.config, {'CACHED_ENDPOINTS': dict()}),
+                        patch.object(mad_responder.CV_CACHE, 'select', return_value=None),
+                        patch.object(mad_responder, 'generate_sql', self.generate_sql)):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def generate_sql(self, *args, **kwargs):
+        # Sleep after g.idcolumn is set, so other requests run in between
+        sql = TestConcurrency.GENERATE_SQL(*args, **kwargs)
+        if int(request.args['_limit']) % 4 == 0:
+            sleep(self.DELAY)
+        return sql
+
+    def fetch(self, idx):
+        limit = idx + 1
+        if idx % 2:
+            url = '/cvterms?_columns=id,cv_term&_limit=%d' % (limit,)
+        else:
+            url = '/cvterms?_limit=%d' % (limit,)
+        start = time()
+        response = app.test_client().get(url)
+        return idx, url, response.status_code, response.json, time() - start
+
+    def test_interleaved_requests(self):
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            results = list(executor.map(self.fetch, range(200)))
+        for idx, url, status, payload, wall in results:
+            self.assertEqual(status, 200)
+            self.assertTrue(payload['rest']['url'].endswith(url))
+            self.assertTrue(payload['rest']['sql_statement'].endswith(' LIMIT %d' % (idx + 1,)))
+            if idx % 2:
+                self.assertNotIn('relationships', payload['data'][0])
+            else:
+                self.assertIn('relationships', payload['data'][0])
+            hms, _, micro = payload['rest']['elapsed_time'].partition('.')
+            hours, minutes, seconds = hms.split(':')
+            elapsed = int(hours) * 3600 + int(minutes) * 60 + int(seconds) \
+                      + float('0.' + (micro or '0'))
+            self.assertLessEqual(elapsed, wall)
+            if (idx + 1) % 4 == 0:
+                # A start time overwritten by a request that began later
+                # would make this shorter than the delay
+                self.assertGreaterEqual(elapsed, self.DELAY)
+
 # ******************************************************************************
 
 if __name__ == '__main__':